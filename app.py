@@ -1,19 +1,41 @@
 from flask import (
     Flask, render_template, request,
-    send_file, after_this_request,
-    redirect, url_for, session, abort, jsonify
+    send_file,
+    redirect, url_for, session, abort, jsonify,
+    g, has_request_context
 )
 import openpyxl
-from openpyxl.styles import PatternFill, Border, Side, Alignment, Font
+from openpyxl.styles import PatternFill, Border, Side, Alignment, Font, NamedStyle
+from openpyxl.styles.fonts import DEFAULT_FONT
 import openpyxl
 from openpyxl import load_workbook  
+from openpyxl.cell import WriteOnlyCell, MergedCell
+from openpyxl.cell.read_only import EMPTY_CELL
+from openpyxl.utils.cell import range_boundaries
+from openpyxl.worksheet.cell_range import CellRange
+import xml.etree.ElementTree as ET
 import datetime as dt
+import cProfile
+import pstats
 import tempfile
+import io
 import os
 import json
+import hashlib
+import sqlite3
 import time
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy, deepcopy
+from bisect import bisect_left, bisect_right
 from functools import wraps
+from contextlib import contextmanager
 from datetime import datetime
+try:
+    import fcntl
+except ImportError:  # Windows — אין מצב multi-process
+    fcntl = None
 
 # ================= CONFIG =================
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -23,10 +45,61 @@ STATE_FILE = os.path.join(APP_DIR, "state.json")
 LOG_FILE = os.path.join(APP_DIR, "audit.log")
 BOOT_FILE = os.path.join(APP_DIR, "boot.json")
 TOUCH_LOG_PATH = os.path.join(APP_DIR, "data", "touch_log.json")
+LOCK_DIR = os.path.join(APP_DIR, "data", "locks")
+
+# כמה תהליכי worker על אותה תיקייה (gunicorn -c gunicorn.conf.py app:app):
+# boot id משותף, נעילות קבצים בין תהליכים ועבודות ייצוא על הדיסק
+MULTIPROCESS = os.environ.get("SHIFTCHANGE_MULTIPROCESS") == "1"
+if MULTIPROCESS and fcntl is None:
+    raise RuntimeError("SHIFTCHANGE_MULTIPROCESS requires fcntl (Linux/macOS)")
+
+def _file_key(path):
+    # כל כתיבה היא os.replace — קובץ חדש מקבל inode חדש, כך ששתי כתיבות באותו
+    # גודל מ-workers שונים באותו tick של mtime עדיין נותנות מפתח שונה
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        return None
+
+# config מפוענח לפי mtime+size של הקובץ; כותבים מסודרים ב-_config_lock
+_config_lock = threading.RLock()
+_config_cache = {"entry": (None, None)}   # (file key, data) — מוחלף כיחידה אחת
 
 def load_config():
-    with open(CONFIG_FILE, encoding="utf-8") as f:
-        return json.load(f)
+    """
+    config.json מה-cache כל עוד הקובץ לא השתנה.
+    האובייקט משותף — לקריאה בלבד; שינויים דרך edit_config().
+    """
+    key = _file_key(CONFIG_FILE)
+    cached_key, data = _config_cache["entry"]
+    if data is not None and cached_key == key:
+        return data
+
+    with _config_lock:
+        with open(CONFIG_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+        _config_cache["entry"] = (key, data)
+        return data
+
+def save_config(cfg):
+    # temp + os.replace — קורא במקביל רואה את הקובץ הישן או החדש, אף פעם לא חצי
+    with _config_lock:
+        _json_save_atomic(CONFIG_FILE, cfg, "config")
+        _config_cache["entry"] = (_file_key(CONFIG_FILE), cfg)
+
+@contextmanager
+def edit_config():
+    """
+    עותק של ה-config לשינוי; נשמר ביציאה מה-with (רק אם השתנה).
+    כל ה-read-modify-write מתבצע תחת _config_lock.
+    """
+    with _config_lock, file_lock("config"):
+        current = load_config()
+        cfg = deepcopy(current)
+        yield cfg
+        if cfg != current:
+            save_config(cfg)
 
 CONFIG = load_config()
 
@@ -34,6 +107,8 @@ app = Flask(__name__)
 app.secret_key = CONFIG["secret_key"]
 app.permanent_session_lifetime = dt.timedelta(hours=24)
 EXPORT_YELLOW = "FFF2CC"
+# דגימות דיבאג של צבעי תאים בהעלאת אקסל שכר (PAYROLL_DEBUG=1)
+PAYROLL_DEBUG = os.environ.get("PAYROLL_DEBUG") == "1"
 # ================= BOOT ID (invalidate sessions after server restart) =================
 def _write_boot_id():
     boot = {"boot_id": f"{int(time.time())}"}
@@ -55,7 +130,259 @@ def _read_boot_id():
         pass
     return _write_boot_id()
 
-CURRENT_BOOT_ID = _write_boot_id()
+def _current_boot_id():
+    # gunicorn.conf.py קובע SHIFTCHANGE_BOOT_ID פעם אחת בתהליך הראשי — כל ה-workers יורשים
+    boot_id = os.environ.get("SHIFTCHANGE_BOOT_ID")
+    if boot_id:
+        return boot_id
+    if MULTIPROCESS:
+        # בלי boot id משותף כל worker היה קורא את boot.json הישן — והתחברויות
+        # היו שורדות הפעלה מחדש של השרת
+        raise RuntimeError("SHIFTCHANGE_MULTIPROCESS requires SHIFTCHANGE_BOOT_ID (see gunicorn.conf.py)")
+    return _write_boot_id()
+
+CURRENT_BOOT_ID = _current_boot_id()
+
+# ================= FILE LOCKS =================
+_file_locks_held = threading.local()
+_file_lock_mutexes = {}   # name -> threading.Lock
+
+@contextmanager
+def file_lock(name):
+    """
+    נעילה בלעדית על משאב בשם name: בין threads של התהליך תמיד, ובין תהליכים
+    (flock על data/locks/<name>.lock) ב-MULTIPROCESS. חוזרת (reentrant) באותו thread.
+    """
+    held = getattr(_file_locks_held, "names", None)
+    if held is None:
+        held = _file_locks_held.names = set()
+    if name in held:
+        yield
+        return
+
+    with _file_lock_mutexes.setdefault(name, threading.Lock()):
+        held.add(name)
+        try:
+            if not MULTIPROCESS:
+                yield
+                return
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            with open(os.path.join(LOCK_DIR, f"{name}.lock"), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            held.discard(name)
+
+# ================= METRICS =================
+# היסטוגרמות ומונים בזיכרון התהליך, מוגשים ב-/metrics בפורמט Prometheus.
+# (במצב multi-process — כל worker מדווח את שלו)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_HELP = {
+    "shiftchange_request_duration_seconds": ("histogram", "HTTP request latency by route"),
+    "shiftchange_span_duration_seconds": ("histogram", "Internal operation latency (workbook, json, audit)"),
+    "shiftchange_audit_lines_total": ("counter", "Audit log lines written"),
+    "shiftchange_template_cache_hits_total": ("counter", "Template cache hits"),
+    "shiftchange_template_cache_misses_total": ("counter", "Template cache misses"),
+    "shiftchange_export_jobs": ("gauge", "Export jobs held in this process by status"),
+}
+
+_metrics_lock = threading.Lock()
+_histograms = {}   # (name, labels) -> {"counts": [...], "sum": float, "count": int}
+_counters = {}     # (name, labels) -> value
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def observe(name, seconds, **labels):
+    key = (name, _labels_key(labels))
+    i = bisect_left(METRICS_BUCKETS, seconds)
+    with _metrics_lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = {"counts": [0] * (len(METRICS_BUCKETS) + 1), "sum": 0.0, "count": 0}
+        h["counts"][i] += 1
+        h["sum"] += seconds
+        h["count"] += 1
+
+def inc(name, value=1, **labels):
+    key = (name, _labels_key(labels))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+@contextmanager
+def span(name, **labels):
+    # זמן של פעולה פנימית (טעינת/שמירת workbook, JSON, audit)
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("shiftchange_span_duration_seconds", time.perf_counter() - t, span=name, **labels)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_timing(response):
+    started = g.get("request_started")
+    if started is not None:
+        observe(
+            "shiftchange_request_duration_seconds",
+            time.perf_counter() - started,
+            route=request.url_rule.rule if request.url_rule else "<unmatched>",
+            method=request.method,
+            status=response.status_code,
+        )
+    return response
+
+def _prom_labels(labels, extra=()):
+    def esc(v):
+        return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    parts = [f'{k}="{esc(v)}"' for k, v in tuple(labels) + tuple(extra)]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def render_metrics():
+    # מונים שמקורם במקומות אחרים — נאספים ברגע ה-scrape
+    with _template_lock:
+        cache_stats = {k: dict(v) for k, v in TEMPLATE_CACHE_STATS.items()}
+    with _export_jobs_lock:
+        job_counts = {}
+        for j in _export_jobs.values():
+            job_counts[j["status"]] = job_counts.get(j["status"], 0) + 1
+
+    with _metrics_lock:
+        histograms = {k: {"counts": list(h["counts"]), "sum": h["sum"], "count": h["count"]}
+                      for k, h in _histograms.items()}
+        counters = dict(_counters)
+
+    for item, st in cache_stats.items():
+        counters[("shiftchange_template_cache_hits_total", (("item", item),))] = st["hits"]
+        counters[("shiftchange_template_cache_misses_total", (("item", item),))] = st["misses"]
+    for status, n in job_counts.items():
+        counters[("shiftchange_export_jobs", (("status", status),))] = n
+
+    lines = []
+    for name, (kind, help_text) in METRICS_HELP.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for le, c in zip(METRICS_BUCKETS, h["counts"]):
+                    cumulative += c
+                    lines.append(f"{name}_bucket{_prom_labels(labels, (('le', repr(le)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_prom_labels(labels, (('le', '+Inf'),))} {h['count']}")
+                lines.append(f"{name}_sum{_prom_labels(labels)} {h['sum']:.6f}")
+                lines.append(f"{name}_count{_prom_labels(labels)} {h['count']}")
+        else:
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{_prom_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+# ================= PROFILING =================
+# פרופיילינג לפי דרישה (מנהל מפעיל ב-/profiles): בקשות ל-routes כבדים רצות תחת
+# cProfile, ורק מה שעבר את הסף נשמר ב-data/profiles (PROFILE_KEEP האחרונים)
+PROFILES_DIR = os.path.join(APP_DIR, "data", "profiles")
+PROFILE_KEEP = 20
+PROFILE_DEFAULTS = {"enabled": False, "threshold_ms": 2000}
+
+# פרופיילר אחד בכל פעם בתהליך — בקשה שמגיעה בזמן שאחרת נמדדת רצה בלי פרופיילר
+_profile_lock = threading.Lock()
+# הפרמטרים של הריצה שנמדדת כרגע ב-thread הזה (בקשה או עבודת ייצוא ברקע)
+_profile_local = threading.local()
+
+def profiling_settings():
+    return {**PROFILE_DEFAULTS, **load_config().get("profiling", {})}
+
+def profile_note(**params):
+    # פרמטרי הבקשה שנשמרים עם הפרופיל (טווח תאריכים, מספר רשומות, מידות גיליון)
+    current = getattr(_profile_local, "params", None)
+    if current is not None:
+        current.update(params)
+
+def _profile_path(profile_id, ext):
+    return os.path.join(PROFILES_DIR, f"{profile_id}.{ext}")
+
+def _load_profile_meta(profile_id):
+    # profile_id מגיע מה-URL — רק YYYYmmdd-HHMMSSffffff-<hex>
+    if len(profile_id) != 28 or any(c not in "0123456789abcdef-" for c in profile_id):
+        return None
+    try:
+        return _json_load(_profile_path(profile_id, "json")) or None
+    except ValueError:
+        return None
+
+def list_profiles():
+    if not os.path.isdir(PROFILES_DIR):
+        return []
+    ids = sorted((os.path.splitext(n)[0] for n in os.listdir(PROFILES_DIR) if n.endswith(".json")), reverse=True)
+    return [meta for meta in map(_load_profile_meta, ids) if meta]
+
+def save_profile(profiler, route_name, user, elapsed_ms, threshold_ms, params):
+    now = dt.datetime.now()
+    profile_id = f"{now:%Y%m%d-%H%M%S%f}-{uuid.uuid4().hex[:6]}"
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+
+    # קודם ה-.prof ואז ה-.json — מה שמופיע ברשימה תמיד שלם
+    profiler.dump_stats(_profile_path(profile_id, "prof"))
+    _json_save_atomic(_profile_path(profile_id, "json"), {
+        "id": profile_id,
+        "route": route_name,
+        "at": now.isoformat(timespec="seconds"),
+        "user": user,
+        "duration_ms": round(elapsed_ms),
+        "threshold_ms": threshold_ms,
+        "params": params,
+    })
+
+    for old in list_profiles()[PROFILE_KEEP:]:
+        safe_remove(_profile_path(old["id"], "json"))
+        safe_remove(_profile_path(old["id"], "prof"))
+
+@contextmanager
+def profile_block(route_name, user, **params):
+    """
+    מריץ את גוף ה-with תחת cProfile (אם הפרופיילינג פעיל) ושומר את הפרופיל
+    אם עבר את הסף. עובד גם מחוץ לבקשה — עבודות ייצוא ברקע.
+    """
+    settings = profiling_settings()
+    if not settings["enabled"] or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    try:
+        _profile_local.params = dict(params)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if elapsed_ms >= settings["threshold_ms"]:
+                try:
+                    save_profile(profiler, route_name, user, elapsed_ms,
+                                 settings["threshold_ms"], _profile_local.params)
+                except Exception:
+                    app.logger.exception("failed to save %s profile", route_name)
+    finally:
+        _profile_local.params = None
+        _profile_lock.release()
+
+def profiled(route_name):
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profile_block(route_name, session.get("user")):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
 
 # ================= SESSION CHECK =================
 @app.before_request
@@ -96,6 +423,26 @@ BORDER_THICK = Border(left=THICK, right=THICK, top=THICK, bottom=THICK)
 ALIGN_CENTER = Alignment(horizontal="center", vertical="center", wrap_text=True)
 FONT_BOLD = Font(bold=True)
 
+# סגנונות משותפים לדוח הייצוא — נרשמים פעם אחת בכל workbook
+# ומוחלים על תא לפי שם, במקום Border/Fill/Alignment נפרדים לכל תא
+REPORT_STYLES = {
+    "report_cell": dict(font=DEFAULT_FONT, border=BORDER_THIN),
+    "report_date": dict(font=FONT_BOLD, fill=HEADER_FILL, border=BORDER_THIN,
+                        alignment=ALIGN_CENTER, number_format="DD.MM.YY"),
+    "report_shift": dict(font=FONT_BOLD, fill=HEADER_FILL, border=BORDER_THIN,
+                         alignment=ALIGN_CENTER),
+    "report_entry": dict(font=DEFAULT_FONT, fill=YELLOW, border=BORDER_THIN,
+                         alignment=ALIGN_CENTER),
+    "report_team": dict(font=FONT_BOLD, fill=TEAM_FILL, border=BORDER_THICK,
+                        alignment=ALIGN_CENTER),
+    "report_team_edge": dict(font=DEFAULT_FONT, border=BORDER_THICK),
+}
+
+def register_report_styles(wb):
+    for name, attrs in REPORT_STYLES.items():
+        if name not in wb.named_styles:
+            wb.add_named_style(NamedStyle(name=name, **attrs))
+
 # ================= CONSTANTS =================
 NAME_COL = 1
 ID_COL = 2
@@ -120,28 +467,30 @@ PAYROLL_META_PATH = os.path.join(APP_DIR, "data", "payroll_meta.json")
 
 # ================= HELPERS =================
 
-def load_payroll_meta():
-    if not os.path.exists(PAYROLL_META_PATH):
-        return {}
-    with open(PAYROLL_META_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def save_payroll_meta(data):
-    os.makedirs(os.path.dirname(PAYROLL_META_PATH), exist_ok=True)
-    with open(PAYROLL_META_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-
 def log_action(action, details=None):
-    ts = dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    user = session.get("user", "anonymous")
-
-    line = f"[{ts}] {user} | {action}"
+    # רשומת JSON אחת לשורה; בתוך בקשה נאסף ב-g ונכתב פעם אחת בסופה
+    record = {
+        "ts": dt.datetime.now().isoformat(timespec="seconds"),
+        "user": session.get("user", "anonymous") if has_request_context() else "system",
+        "action": action,
+    }
     if details:
-        line += " | " + " | ".join(details)
-
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(line + "\n")
+        record["details"] = [str(d) for d in details]
+
+    line = json.dumps(record, ensure_ascii=False)
+    if has_request_context():
+        g.setdefault("audit_lines", []).append(line)
+    else:
+        write_audit_lines([line])
+
+@app.teardown_request
+def flush_audit_log(exc=None):
+    lines = g.pop("audit_lines", None)
+    if lines:
+        try:
+            write_audit_lines(lines)
+        except Exception:
+            app.logger.exception("audit log flush failed")
 def find_first_employee_row(ws):
     """
     מחפש את השורה הראשונה שבה:
@@ -168,8 +517,8 @@ def update_state(action_name=None):
         "last_modified_by": session.get("user"),
         "last_modified_at": dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
     }
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    with file_lock("state"):
+        _json_save_atomic(STATE_FILE, data, "state")
 
     if action_name:
         log_action(action_name)
@@ -205,30 +554,211 @@ def safe_remove(path):
     except Exception:
         pass
 
-def read_audit_logs(max_lines=500):
-    if not os.path.exists(LOG_FILE):
-        return []
+# ================= AUDIT LOG =================
+# audit.log הוא הסגמנט הפעיל; כשהוא עובר AUDIT_ROTATE_BYTES או שהתחלף היום
+# הוא מועבר ל-data/audit/audit-<seq>.log, ו-index.json שומר את טווח הזמנים
+# של כל סגמנט (כדי שסינון לפי תאריך ידלג על סגמנטים שלמים).
+AUDIT_DIR = os.path.join(APP_DIR, "data", "audit")
+AUDIT_INDEX_PATH = os.path.join(AUDIT_DIR, "index.json")
+AUDIT_ROTATE_BYTES = 5 * 1024 * 1024
+AUDIT_READ_BLOCK = 64 * 1024
+AUDIT_TS_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+_audit_lock = threading.Lock()
+
+def iter_lines_reverse(path, before=None):
+    """
+    שורות הקובץ מהסוף להתחלה, כ-(offset, bytes), בקריאה לאחור בבלוקים —
+    בלי לטעון את כל הקובץ. before: offset שממנו והלאה לא קוראים.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        if before is not None:
+            pos = min(pos, before)
+
+        tail = b""
+        while pos > 0:
+            size = min(AUDIT_READ_BLOCK, pos)
+            pos -= size
+            f.seek(pos)
+            buf = f.read(size) + tail
+            lines = buf.split(b"\n")
+            # השורה הראשונה אולי חתוכה — נשלים אותה בבלוק הבא
+            tail = lines.pop(0)
+            end = pos + len(buf)
+            for line in reversed(lines):
+                start = end - len(line)
+                yield start, line
+                end = start - 1
+        if tail:
+            yield 0, tail
+
+def parse_audit_line(line):
+    """
+    שורת לוג → {"at", "ts", "user", "action"} או None.
+    תומך גם בפורמט הטקסט הישן: [dd/mm/YYYY HH:MM:SS] user | action | ...
+    """
+    line = line.strip()
+    if line.startswith("{"):
+        try:
+            rec = json.loads(line)
+            at = dt.datetime.fromisoformat(rec["ts"])
+        except (ValueError, KeyError, TypeError):
+            return None
+        action = rec.get("action", "")
+        if rec.get("details"):
+            action += " | " + " | ".join(rec["details"])
+        return {"at": at, "ts": at.strftime(AUDIT_TS_FORMAT), "user": rec.get("user", ""), "action": action}
+
+    if line.startswith("[") and "]" in line and " | " in line:
+        ts = line[1:line.index("]")]
+        rest = line[line.index("]") + 1:].strip()
+        if " | " in rest:
+            user, action = rest.split(" | ", 1)
+            try:
+                at = dt.datetime.strptime(ts, AUDIT_TS_FORMAT)
+            except ValueError:
+                at = None
+            return {"at": at, "ts": ts, "user": user.strip(), "action": action.strip()}
+    return None
+
+def _audit_edge_ts(path, last=False):
+    # ts (ISO) של הרשומה הראשונה/האחרונה בקובץ
     try:
-        with open(LOG_FILE, encoding="utf-8") as f:
-            lines = f.readlines()[-max_lines:]
-        logs = []
-        for line in reversed(lines):
-            line = line.strip()
-            if not line:
+        with open(path, "rb") as f:
+            lines = (raw for _, raw in iter_lines_reverse(path)) if last else f
+            for raw in lines:
+                row = parse_audit_line(raw.decode("utf-8", errors="replace"))
+                if row and row["at"]:
+                    return row["at"].isoformat(timespec="seconds")
+    except FileNotFoundError:
+        pass
+    return None
+
+def _load_audit_index():
+    # נקרא תחת _audit_lock
+    index = _json_load(AUDIT_INDEX_PATH, "audit_index")
+    if not index:
+        # audit.log קיים מלפני הרוטציה — הוא הסגמנט הפעיל הראשון
+        index = {"active": {"seq": 1, "first_ts": _audit_edge_ts(LOG_FILE)}, "segments": []}
+        _json_save_atomic(AUDIT_INDEX_PATH, index, "audit_index")
+    return index
+
+def _rotate_audit_log(index):
+    active = index["active"]
+    name = f"audit-{active['seq']:06d}.log"
+    last_ts = _audit_edge_ts(LOG_FILE, last=True)
+    os.makedirs(AUDIT_DIR, exist_ok=True)
+    os.replace(LOG_FILE, os.path.join(AUDIT_DIR, name))
+    index["segments"].append({
+        "seq": active["seq"],
+        "file": name,
+        "first_ts": active.get("first_ts"),
+        "last_ts": last_ts,
+    })
+    index["active"] = {"seq": active["seq"] + 1, "first_ts": None}
+
+def write_audit_lines(lines):
+    data = ("\n".join(lines) + "\n").encode("utf-8")
+    now = dt.datetime.now()
+
+    inc("shiftchange_audit_lines_total", len(lines))
+    with span("audit_write"), _audit_lock, file_lock("audit"):
+        index = _load_audit_index()
+        first_ts = index["active"].get("first_ts")
+        size = os.path.getsize(LOG_FILE) if os.path.exists(LOG_FILE) else 0
+
+        if size and (
+            size + len(data) > AUDIT_ROTATE_BYTES
+            or (first_ts and first_ts[:10] != now.date().isoformat())
+        ):
+            _rotate_audit_log(index)
+            size = 0
+
+        if not size:
+            index["active"]["first_ts"] = now.isoformat(timespec="seconds")
+            _json_save_atomic(AUDIT_INDEX_PATH, index, "audit_index")
+
+        with open(LOG_FILE, "ab") as f:
+            f.write(data)
+
+def reset_audit_log():
+    with _audit_lock, file_lock("audit"):
+        index = _json_load(AUDIT_INDEX_PATH, "audit_index")
+        for seg in index.get("segments", []):
+            safe_remove(os.path.join(AUDIT_DIR, seg["file"]))
+        safe_remove(AUDIT_INDEX_PATH)
+        safe_remove(LOG_FILE)
+
+def _audit_sources():
+    # (seq, path, first_ts, last_ts) מהסגמנט החדש לישן
+    with _audit_lock:
+        index = _load_audit_index()
+    active = index["active"]
+    sources = [(active["seq"], LOG_FILE, active.get("first_ts"), None)]
+    for seg in reversed(index["segments"]):
+        sources.append((seg["seq"], os.path.join(AUDIT_DIR, seg["file"]), seg.get("first_ts"), seg.get("last_ts")))
+    return sources
+
+def parse_audit_cursor(cursor):
+    # "<seq>:<offset>" (offset ריק = מסוף הסגמנט) → (seq, offset); ValueError אם לא תקין
+    seq, sep, offset = cursor.partition(":")
+    if not sep:
+        raise ValueError(cursor)
+    return int(seq), (int(offset) if offset else None)
+
+def read_audit_logs(max_lines=500, before=None, user=None, action=None,
+                    date_from=None, date_to=None):
+    """
+    הרשומות האחרונות (החדשה ראשונה) → (logs, cursor).
+    cursor ("<seq>:<offset>") ממשיך אחורה (before=cursor), או None בהתחלה.
+    user — התאמה מלאה; action — מכיל; date_from/date_to — date כולל.
+    """
+    seq_before, offset_before = parse_audit_cursor(before) if before else (None, None)
+    logs = []
+    try:
+        sources = _audit_sources()
+        for n, (seq, path, first_ts, last_ts) in enumerate(sources):
+            if seq_before is not None and seq > seq_before:
+                continue
+            if date_to and first_ts and first_ts[:10] > date_to.isoformat():
+                continue
+            if date_from and last_ts and last_ts[:10] < date_from.isoformat():
+                break
+            if not os.path.exists(path):
                 continue
-            if line.startswith("[") and "]" in line and " | " in line:
-                ts = line[1:line.index("]")]
-                rest = line[line.index("]") + 1:].strip()
-                if " | " in rest:
-                    user, action = rest.split(" | ", 1)
-                    logs.append({"ts": ts, "user": user.strip(), "action": action.strip()})
-        return logs
-    except Exception:
-        return []
 
-def save_config(cfg):
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(cfg, f, ensure_ascii=False, indent=2)
+            start = offset_before if seq == seq_before else None
+            for offset, raw in iter_lines_reverse(path, start):
+                row = parse_audit_line(raw.decode("utf-8", errors="replace"))
+                if not row:
+                    continue
+
+                if date_from or date_to:
+                    if not row["at"]:
+                        continue
+                    day = row["at"].date()
+                    if date_from and day < date_from:
+                        # הלוג כרונולוגי — מכאן והלאה הכל ישן יותר
+                        return logs, None
+                    if date_to and day > date_to:
+                        continue
+                if user and row["user"] != user:
+                    continue
+                if action and action not in row["action"]:
+                    continue
+
+                logs.append(row)
+                if len(logs) >= max_lines:
+                    if offset:
+                        return logs, f"{seq}:{offset}"
+                    if n + 1 < len(sources):
+                        return logs, f"{sources[n + 1][0]}:"
+                    return logs, None
+        return logs, None
+    except Exception:
+        return logs, None
 
 def _parse_date(value):
     return dt.datetime.strptime(value, "%Y-%m-%d").date()
@@ -257,7 +787,7 @@ def _clear_dynamic_columns_only(ws):
 
 # ================= AUTH =================
 def is_super_admin():
-    return session.get("user") == CONFIG.get("super_admin")
+    return session.get("user") == load_config().get("super_admin")
 def login_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
@@ -270,9 +800,29 @@ def admin_required():
     if session.get("role") != "admin":
         abort(403)
 
+# ================= MERGED ROWS INDEX =================
+def build_merged_row_index(ws):
+    """
+    מעבר יחיד על המיזוגים בגיליון → set של שורות שממוזגות לרוחב
+    (מיזוג שמתחיל ונגמר באותה שורה). כך בדיקת "שורת צוות" היא O(1).
+    """
+    rows = set()
+    try:
+        for rng in ws.merged_cells.ranges:
+            if rng.min_row == rng.max_row:
+                rows.add(rng.min_row)
+    except Exception:
+        pass
+    return rows
+
+def is_team_row(merged_rows, row):
+    # אם השורה ממוזגת לרוחב => זו שורת צוות
+    return row in merged_rows
+
 # ================= LOAD TEAMS =================
-def load_teams_with_rows():
-    wb = openpyxl.load_workbook(TEMPLATE)
+def _parse_teams_with_rows():
+    with span("workbook_load", source="template"):
+        wb = openpyxl.load_workbook(TEMPLATE)
     ws = wb.active
 
     teams = {}
@@ -280,6 +830,8 @@ def load_teams_with_rows():
     current_team = None
     default_team = "מנהלי משמרת"
 
+    merged_rows = build_merged_row_index(ws)
+
     row = find_first_employee_row(ws)
     empty = 0
 
@@ -297,12 +849,7 @@ def load_teams_with_rows():
         name = str(name).strip()
 
 # בדיקה אם השורה ממוזגת לרוחב → צוות
-        is_team_row = any(
-            rng.min_row == row and rng.max_row == row
-            for rng in ws.merged_cells.ranges
-        )
-
-        if is_team_row:
+        if is_team_row(merged_rows, row):
             current_team = name
             teams.setdefault(current_team, [])
             team_rows[current_team] = row
@@ -318,6 +865,52 @@ def load_teams_with_rows():
 
     return teams, team_rows
 
+# ================= TEMPLATE CACHE =================
+# מבנה.xlsx משתנה לעיתים רחוקות — כל מה שנגזר ממנו נבנה פעם אחת ונשמר בזיכרון.
+# המטמון נפסל אוטומטית כשה-mtime/גודל של הקובץ משתנים.
+_template_lock = threading.RLock()   # builders may read other cached items
+_template_cache = {}          # name -> (key, value)
+TEMPLATE_CACHE_STATS = {}     # name -> {"hits", "misses"}
+
+def _template_key():
+    st = os.stat(TEMPLATE)
+    return (st.st_mtime_ns, st.st_size)
+
+def template_cached(name, build):
+    key = _template_key()
+    with _template_lock:
+        stats = TEMPLATE_CACHE_STATS.setdefault(name, {"hits": 0, "misses": 0})
+        cached = _template_cache.get(name)
+        if cached and cached[0] == key:
+            stats["hits"] += 1
+            return cached[1]
+
+        stats["misses"] += 1
+        value = build()
+        _template_cache[name] = (key, value)
+        return value
+
+def _build_roster():
+    teams, team_rows = _parse_teams_with_rows()
+    return {
+        "teams": teams,
+        "team_rows": team_rows,
+        "emp_row": {e["name"]: e["row"] for t in teams.values() for e in t},
+    }
+
+def get_roster():
+    """
+    מחזיר dict עם:
+    - teams: {team: [{"name", "row"}]}
+    - team_rows: {team: row}
+    - emp_row: {name: row}
+    """
+    return template_cached("roster", _build_roster)
+
+def load_teams_with_rows():
+    roster = get_roster()
+    return roster["teams"], roster["team_rows"]
+
 def load_teams():
     teams, _ = load_teams_with_rows()
     return teams
@@ -338,32 +931,23 @@ def build_report_headers(ws, start_date, end_date):
 
         dc = ws.cell(HEADER_DATE_ROW, start_col)
         dc.value = d
-        dc.number_format = "DD.MM.YY"
-        dc.font = FONT_BOLD
-        dc.alignment = ALIGN_CENTER
-        dc.fill = HEADER_FILL
+        dc.style = "report_date"
 
         for i, shift in enumerate(SHIFT_TYPES):
             c = ws.cell(HEADER_SHIFT_ROW, start_col + i)
             c.value = f"משמרת {shift}"
-            c.font = FONT_BOLD
-            c.alignment = ALIGN_CENTER
-            c.fill = HEADER_FILL
-            c.border = BORDER_THIN
+            c.style = "report_shift"
 
-        apply_border(ws, HEADER_DATE_ROW, HEADER_SHIFT_ROW, start_col, end_col, thick=True)
         col += 3
 
 # ================= ROUTES =================
 @app.route("/login", methods=["GET", "POST"])
 def login():
-    global CONFIG
     if request.method == "POST":
         u = request.form.get("username")
         p = request.form.get("password")
 
-        CONFIG = load_config()
-        user = CONFIG["users"].get(u)
+        user = load_config()["users"].get(u)
 
         if user and user.get("password") == p:
             session.clear()
@@ -396,7 +980,7 @@ def index():
         user=session["user"],
         role=session.get("role"),
         state=load_state(),
-        config=CONFIG
+        config=load_config()
 
 
     )
@@ -405,15 +989,112 @@ def index():
 @login_required
 def audit():
     admin_required()
-    logs = read_audit_logs(max_lines=800)
+
+    args = request.args
+    filters = {
+        "user": args.get("user", "").strip(),
+        "action": args.get("action", "").strip(),
+        "from": args.get("from", ""),
+        "to": args.get("to", ""),
+    }
+    try:
+        before = args.get("before") or None
+        if before:
+            parse_audit_cursor(before)
+        date_from = _parse_date(filters["from"]) if filters["from"] else None
+        date_to = _parse_date(filters["to"]) if filters["to"] else None
+    except ValueError:
+        return jsonify({"error": "bad before/from/to"}), 400
+
+    logs, cursor = read_audit_logs(
+        max_lines=800,
+        before=before,
+        user=filters["user"] or None,
+        action=filters["action"] or None,
+        date_from=date_from,
+        date_to=date_to,
+    )
     return render_template(
         "audit.html",
         logs=logs,
+        cursor=cursor,
+        filters=filters,
+        user=session["user"],
+        role=session.get("role"),
+        state=load_state()
+    )
+
+@app.get("/metrics")
+@login_required
+def metrics():
+    admin_required()
+    return app.response_class(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/profiles")
+@login_required
+def profiles():
+    admin_required()
+    return render_template(
+        "profiles.html",
+        profiles=list_profiles(),
+        settings=profiling_settings(),
+        keep=PROFILE_KEEP,
         user=session["user"],
         role=session.get("role"),
         state=load_state()
     )
 
+@app.post("/profiles/settings")
+@login_required
+def profiles_settings():
+    admin_required()
+    enabled = request.form.get("enabled") == "1"
+    try:
+        threshold_ms = int(request.form.get("threshold_ms", PROFILE_DEFAULTS["threshold_ms"]))
+    except ValueError:
+        return jsonify({"error": "bad threshold_ms"}), 400
+    if threshold_ms < 0:
+        return jsonify({"error": "bad threshold_ms"}), 400
+
+    with edit_config() as cfg:
+        cfg["profiling"] = {"enabled": enabled, "threshold_ms": threshold_ms}
+
+    log_action("profiling settings", [f"enabled={enabled}", f"threshold_ms={threshold_ms}"])
+    return redirect(url_for("profiles"))
+
+@app.get("/profiles/<profile_id>")
+@login_required
+def profile_view(profile_id):
+    # סיכום טקסט (cumulative) — לקריאה בדפדפן בלי כלים נוספים
+    admin_required()
+    meta = _load_profile_meta(profile_id)
+    if not meta:
+        abort(404)
+    out = io.StringIO()
+    out.write(json.dumps(meta, ensure_ascii=False, indent=2) + "\n\n")
+    pstats.Stats(_profile_path(profile_id, "prof"), stream=out).sort_stats("cumulative").print_stats(60)
+    return app.response_class(out.getvalue(), mimetype="text/plain")
+
+@app.get("/profiles/<profile_id>/download")
+@login_required
+def profile_download(profile_id):
+    admin_required()
+    meta = _load_profile_meta(profile_id)
+    if not meta:
+        abort(404)
+    return send_file(
+        _profile_path(profile_id, "prof"),
+        as_attachment=True,
+        download_name=f"{meta['route'].strip('/').replace('/', '-')}-{profile_id}.prof"
+    )
+
+@app.get("/cache-stats")
+@login_required
+def cache_stats():
+    admin_required()
+    with _template_lock:
+        return jsonify({"template": {k: dict(v) for k, v in TEMPLATE_CACHE_STATS.items()}})
+
 @app.route("/users", methods=["GET"])
 @login_required
 def users():
@@ -438,44 +1119,42 @@ def users_create():
     password = (data.get("password") or "").strip()
     role = data.get("role", "user")
 
-    cfg = load_config()
-
-    if not username or not password:
-        return render_template(
-            "users.html",
-            users=cfg.get("users", {}),
-            error="חובה להזין שם משתמש וסיסמה",
-            user=session["user"],
-            role=session.get("role"),
-            state=load_state()
-        )
-
-    if username in cfg["users"]:
-        return render_template(
-            "users.html",
-            users=cfg.get("users", {}),
-            error="שם משתמש כבר קיים",
-            user=session["user"],
-            role=session.get("role"),
-            state=load_state()
-        )
-
-    if len(password) < 6:
-        return render_template(
-            "users.html",
-            users=cfg.get("users", {}),
-            error="סיסמה חייבת להכיל לפחות 6 תווים",
-            user=session["user"],
-            role=session.get("role"),
-            state=load_state()
-        )
+    with edit_config() as cfg:
+        if not username or not password:
+            return render_template(
+                "users.html",
+                users=cfg.get("users", {}),
+                error="חובה להזין שם משתמש וסיסמה",
+                user=session["user"],
+                role=session.get("role"),
+                state=load_state()
+            )
+
+        if username in cfg["users"]:
+            return render_template(
+                "users.html",
+                users=cfg.get("users", {}),
+                error="שם משתמש כבר קיים",
+                user=session["user"],
+                role=session.get("role"),
+                state=load_state()
+            )
 
-    cfg["users"][username] = {
-        "password": password,
-        "role": role
-    }
+        if len(password) < 6:
+            return render_template(
+                "users.html",
+                users=cfg.get("users", {}),
+                error="סיסמה חייבת להכיל לפחות 6 תווים",
+                user=session["user"],
+                role=session.get("role"),
+                state=load_state()
+            )
+
+        cfg["users"][username] = {
+            "password": password,
+            "role": role
+        }
 
-    save_config(cfg)
     update_state("create user")
     log_action("create user", [f"user={username}", f"role={role}"])
 
@@ -492,21 +1171,20 @@ def users_update():
     password = data.get("password")
     role = data.get("role")
 
-    cfg = load_config()
-    user = cfg["users"].get(username)
+    with edit_config() as cfg:
+        user = cfg["users"].get(username)
 
-    if not user:
-        return jsonify(error="משתמש לא קיים"), 404
+        if not user:
+            return jsonify(error="משתמש לא קיים"), 404
 
-    if password:
-        if len(password) < 6:
-            return jsonify(error="סיסמה קצרה מדי"), 400
-        user["password"] = password
+        if password:
+            if len(password) < 6:
+                return jsonify(error="סיסמה קצרה מדי"), 400
+            user["password"] = password
 
-    if role:
-        user["role"] = role
+        if role:
+            user["role"] = role
 
-    save_config(cfg)
     update_state("update user")
     log_action("update user", [f"user={username}"])
 
@@ -526,25 +1204,23 @@ def users_delete():
     if username == current_user:
         return jsonify(error="לא ניתן למחוק את המשתמש שמחובר כעת"), 400
 
-    cfg = load_config()
-
-    # 🔐 בדיקת סיסמה של המשתמש המחובר
-    admin_user = cfg["users"].get(current_user)
-    if not admin_user or admin_user["password"] != password:
-        return jsonify(error="סיסמה שגויה"), 403
+    with edit_config() as cfg:
+        # 🔐 בדיקת סיסמה של המשתמש המחובר
+        admin_user = cfg["users"].get(current_user)
+        if not admin_user or admin_user["password"] != password:
+            return jsonify(error="סיסמה שגויה"), 403
 
-    # בדיקה שהמשתמש הנמחק קיים
-    if username not in cfg["users"]:
-        return jsonify(error="משתמש לא קיים"), 404
+        # בדיקה שהמשתמש הנמחק קיים
+        if username not in cfg["users"]:
+            return jsonify(error="משתמש לא קיים"), 404
 
-    # ❗ לפחות מנהל אחד
-    admins = [u for u in cfg["users"].values() if u["role"] == "admin"]
-    if cfg["users"][username]["role"] == "admin" and len(admins) == 1:
-        return jsonify(error="חייב להישאר לפחות מנהל אחד"), 400
+        # ❗ לפחות מנהל אחד
+        admins = [u for u in cfg["users"].values() if u["role"] == "admin"]
+        if cfg["users"][username]["role"] == "admin" and len(admins) == 1:
+            return jsonify(error="חייב להישאר לפחות מנהל אחד"), 400
 
-    # מחיקה
-    del cfg["users"][username]
-    save_config(cfg)
+        # מחיקה
+        del cfg["users"][username]
 
     update_state("delete user")
     log_action(
@@ -560,15 +1236,11 @@ def users_delete():
 @login_required
 def reset():
     # 🔐 רק מנהל על
-    if session.get("user") != CONFIG.get("super_admin"):
+    if session.get("user") != load_config().get("super_admin"):
         abort(403)
 
     paths = [
         STATE_FILE,
-        LOG_FILE,
-        PAYROLL_STATUS_PATH,
-        TOUCH_LOG_PATH,        # ✅ איפוס שינויים
-        PAYROLL_META_PATH      # ✅ איפוס זמן שכר
     ]
 
     for p in paths:
@@ -578,8 +1250,22 @@ def reset():
         except Exception:
             pass
 
+    reset_audit_log()
+
+    # ✅ איפוס שינויים, סטטוס שכר וזמן שכר
+    reset_storage()
+
     update_state("reset system")
     return jsonify({"ok": True})
+def entry_date(value):
+    # תאריך של רשומה למאגר: רק YYYY-MM-DD תקין (כמו המפתחות של touch_log), אחרת None
+    try:
+        if _parse_date(value).isoformat() == value:
+            return value
+    except (TypeError, ValueError):
+        pass
+    return None
+
 @app.post("/touch")
 @login_required
 def touch():
@@ -593,11 +1279,17 @@ def touch():
         "last_modified_by": user,
         "last_modified_at": now
     }
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    with file_lock("state"):
+        _json_save_atomic(STATE_FILE, state, "state")
 
-    touch_log = load_touch_log()
-    payroll_status = load_payroll_status()
+    def entry_key(e):
+        return f"{e.get('date')}|{e.get('name')}|{e.get('shift') or ''}"
+
+    # רק הרשומות שנוגעים בהן — לא כל ההיסטוריה
+    touch_log = get_touch_entries(entry_key(e) for e in entries)
+    stored = get_entries(entry_key(e) for e in entries)
+    changes = {}
+    entry_changes = {}
 
     for e in entries:
         date  = e.get("date")
@@ -606,12 +1298,23 @@ def touch():
         action = (e.get("action") or "").strip()
         note   = (e.get("note") or "").strip()
 
-        key = f"{date}|{name}|{shift}"
+        key = entry_key(e)
 
         # 
 
         prev = touch_log.get(key)
 
+        # מאגר הרשומות: פעולה והערה ריקות = הרשומה נמחקה (משמרת הוחלפה / שורה נוקתה)
+        old = stored.get(key)
+        if not (action or note):
+            if old is None and not prev:
+                continue   # אין מה למחוק
+            entry_changes[key] = None
+        elif entry_date(date) and name and shift and (
+            not old or (old.get("action"), old.get("note")) != (action, note)
+        ):
+            entry_changes[key] = {"action": action, "note": note, "updated_at": now, "by": user}
+
         new_value = f"{action}|{note}"
 
         # ❌ אם הערך זהה למה שכבר נשמר → לא שינוי
@@ -620,13 +1323,9 @@ def touch():
 
         # ✅ שינוי אמיתי
 
-        date_prefix = f"{date}|{name}|"
-        had_payroll = any(
-            k.startswith(date_prefix)
-            for k in payroll_status.keys()
-        )
+        had_payroll = payroll_has_day(str(date), str(name))
 
-        touch_log[key] = {
+        touch_log[key] = changes[key] = {
             "touched_at": now,
             "by": user,
             "value": new_value,
@@ -643,40 +1342,56 @@ def touch():
             ]
         )
 
-    save_touch_log(touch_log)
+    update_entries(entry_changes)
+    update_touch_log(changes)
     return jsonify(state)
 
-@app.post("/export")
+@app.post("/entries/import")
 @login_required
-def export():
+def entries_import():
+    """
+    העברה חד-פעמית של טיוטות שנשמרו רק ב-localStorage של הדפדפן (לפני שהשרת
+    שמר את הרשומות). מוסיף רק מפתחות שאין להם עדיין רשומה בשרת — בלי touch_log.
+    """
     data = request.json or {}
-
-    # --- validate input ---
-    try:
-        report_from = _parse_date(data["report_from"])
-        report_to = _parse_date(data["report_to"])
-    except Exception:
-        return jsonify({"error": "report_from/report_to invalid. expected YYYY-MM-DD"}), 400
-
-    if report_to < report_from:
-        return jsonify({"error": "טווח תאריכים לא תקין: 'עד' קטן מ-'מדוח'"}), 400
-
     entries = data.get("entries", [])
-    if not entries:
-        return jsonify({"error": "no entries to export"}), 400
-
-    wb = openpyxl.load_workbook(TEMPLATE)
-    ws = wb.active
-
-    # ✅ FIX: clean only dynamic columns (C..), without destroying static header merges
-    _clear_dynamic_columns_only(ws)
-
-    # build dynamic headers for the selected range
-    build_report_headers(ws, report_from, report_to)
 
-    teams, team_rows = load_teams_with_rows()
-    emp_row = {e["name"]: e["row"] for t in teams.values() for e in t}
+    user = session.get("user")
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+    incoming = {}
+    for e in entries:
+        name = e.get("name")
+        shift = e.get("shift")
+        action = (e.get("action") or "").strip()
+        note = (e.get("note") or "").strip()
+        date = entry_date(e.get("date"))
+        if not date or not name or not shift or not (action or note):
+            continue
+        incoming[f"{date}|{name}|{shift}"] = {"action": action, "note": note, "updated_at": now, "by": user}
+
+    # מפתח שנוקה בשרת (נגיעה אחרונה ריקה) לא חוזר מטיוטה ישנה
+    cleared = {k for k, t in get_touch_entries(incoming).items() if t.get("value") == "|"}
+    added = add_missing_entries({k: rec for k, rec in incoming.items() if k not in cleared})
+
+    if added:
+        log_action("import entries", [f"added={added}"])
+    return jsonify({"ok": True, "added": added})
+
+# ================= EXPORT =================
+# "template": טוען את מבנה.xlsx ובונה את הדוח במודל של openpyxl (ברירת מחדל)
+# "stream":   כותב שורה-שורה ב-write_only — לטווחים ארוכים
+EXPORT_ENGINES = ("template", "stream")
+# "client": הרשומות מגיעות בגוף הבקשה; "server": נקראות ממאגר הרשומות לפי הטווח
+EXPORT_SOURCES = ("client", "server")
+# מעל הגודל הזה קובץ הייצוא נשפך מהזיכרון לקובץ זמני
+EXPORT_SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+def resolve_export_cells(report_from, report_to, entries, emp_row):
+    """
+    ממפה את הרשומות לתאי הדוח: {(row, col): text}
+    רשומה מאוחרת דורסת מוקדמת (כמו כתיבה ישירה לתא).
+    """
     # map (date, shift) -> column
     col_map = {}
 
@@ -686,6 +1401,7 @@ def export():
             col_map[(d, shift)] = col + i
         col += 3
 
+    cells = {}
     for e in entries:
         try:
             date = _parse_date(e["date"])
@@ -711,45 +1427,461 @@ def export():
         if note:
             text = f"{action} – {note}" if action else note
 
-        
+        cells[(emp_row[name], col)] = text
 
+    return cells
+
+def _build_stripped_template():
+    """
+    מבנה.xlsx אחרי _clear_dynamic_columns_only — התוצאה זהה בכל ייצוא,
+    אז מכינים אותה פעם אחת (כ-bytes של xlsx) וכל ייצוא נטען ממנה.
+    """
+    with span("workbook_load", source="template"):
+        wb = openpyxl.load_workbook(TEMPLATE)
 
-        cell = ws.cell(emp_row[name], col)
+    # ✅ FIX: clean only dynamic columns (C..), without destroying static header merges
+    _clear_dynamic_columns_only(wb.active)
+
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+def load_stripped_template():
+    snapshot = template_cached("stripped_template", _build_stripped_template)
+    with span("workbook_load", source="stripped_template"):
+        return openpyxl.load_workbook(io.BytesIO(snapshot))
+
+def build_export_template(report_from, report_to, cells, team_rows):
+    wb = load_stripped_template()
+    ws = wb.active
+    register_report_styles(wb)
+
+    # build dynamic headers for the selected range
+    build_report_headers(ws, report_from, report_to)
+
+    for (r, col), text in cells.items():
+        cell = ws.cell(r, col)
         cell.value = text
-        cell.fill = YELLOW
-        cell.border = BORDER_THIN
-        cell.alignment = ALIGN_CENTER
+        cell.style = "report_entry"
 
-    # global borders
-    apply_border(ws, 1, ws.max_row, 1, ws.max_column)
+    # global borders: העמודות הסטטיות שומרות על העיצוב שלהן (רק מסגרת),
+    # בעמודות הדינמיות כל תא שעוד לא עוצב (כולל תאים מכוסים במיזוג) מקבל report_cell
+    max_row, max_col = ws.max_row, ws.max_column
+    apply_border(ws, 1, max_row, 1, 2)
+    for row in ws.iter_rows(min_row=1, max_row=max_row, min_col=3, max_col=max_col):
+        for cell in row:
+            if not cell.has_style or isinstance(cell, MergedCell):
+                cell.style = "report_cell"
 
     # team header rows (merge across current max_column)
     for team, r in team_rows.items():
         try:
-            ws.merge_cells(start_row=r, start_column=1, end_row=r, end_column=ws.max_column)
+            ws.merge_cells(start_row=r, start_column=1, end_row=r, end_column=max_col)
         except Exception:
             pass
         c = ws.cell(r, 1)
         c.value = team
-        c.fill = TEAM_FILL
-        c.font = FONT_BOLD
-        c.alignment = ALIGN_CENTER
-        apply_border(ws, r, r, 1, ws.max_column, thick=True)
+        c.style = "report_team"
+        for col in range(2, max_col + 1):
+            ws.cell(r, col).style = "report_team_edge"
+
+    return wb
+
+def _build_static_layout():
+    """
+    התבנית אחרי הסרת העמודות הדינמיות, בצורה שמנוע ה-stream משכפל:
+    תאי עמודות A..B (ערך + עיצוב), מיזוגים סטטיים, מידות ותצוגת הגיליון.
+    """
+    ws = load_stripped_template().active
+
+    rows = []
+    for r in range(1, ws.max_row + 1):
+        static = []
+        for c in (NAME_COL, ID_COL):
+            cell = ws.cell(r, c)
+            if isinstance(cell, MergedCell):
+                # תא מכוסה במיזוג — רק מסגרת
+                static.append(None)
+                continue
+            static.append({
+                "value": cell.value,
+                "font": copy(cell.font),
+                "fill": copy(cell.fill),
+                "alignment": copy(cell.alignment),
+                "protection": copy(cell.protection),
+                "number_format": cell.number_format,
+            })
+        rows.append(static)
+
+    return {
+        "rows": rows,
+        "merged": [str(rng) for rng in ws.merged_cells.ranges],
+        "col_widths": {
+            k: (d.width, d.hidden) for k, d in ws.column_dimensions.items()
+        },
+        "row_heights": {
+            r: d.height for r, d in ws.row_dimensions.items() if d.height
+        },
+        "views": copy(ws.views),
+        "sheet_format": copy(ws.sheet_format),
+        "sheet_properties": copy(ws.sheet_properties),
+        "page_margins": copy(ws.page_margins),
+        "print_options": copy(ws.print_options),
+        "title": ws.title,
+    }
+
+def get_static_layout():
+    return template_cached("static_layout", _build_static_layout)
+
+def _wo_cell(ws, proto, value=None):
+    # תא write-only עם עיצוב מועתק מתא אב-טיפוס (בלי חישוב style מחדש)
+    cell = WriteOnlyCell(ws, value)
+    cell._style = copy(proto._style)
+    return cell
+
+def _wo_proto(ws, style):
+    cell = WriteOnlyCell(ws)
+    cell.style = style
+    return cell
+
+def build_export_stream(report_from, report_to, cells, team_rows):
+    """
+    מנוע ייצוא write_only: מייצר את אותו דוח כמו build_export_template
+    (תאים, מיזוגים, מסגרות ומידות), אבל כותב שורה-שורה ישירות לקובץ
+    בלי לטעון את התבנית למודל של openpyxl.
+    """
+    layout = get_static_layout()
+    days = list(daterange(report_from, report_to))
+    max_col = 2 + 3 * len(days)
+    max_row = len(layout["rows"])
+    team_by_row = {r: team for team, r in team_rows.items()}
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(layout["title"])
+
+    ws.views = copy(layout["views"])
+    ws.sheet_format = copy(layout["sheet_format"])
+    ws.sheet_properties = copy(layout["sheet_properties"])
+    ws.page_margins = copy(layout["page_margins"])
+    ws.print_options = copy(layout["print_options"])
+    for key, (width, hidden) in layout["col_widths"].items():
+        ws.column_dimensions[key].width = width
+        ws.column_dimensions[key].hidden = hidden
+    for r, height in layout["row_heights"].items():
+        ws.row_dimensions[r].height = height
+
+    register_report_styles(wb)
+    plain = _wo_proto(ws, "report_cell")
+    thick = _wo_proto(ws, "report_team_edge")
+    team = _wo_proto(ws, "report_team")
+    date_hdr = _wo_proto(ws, "report_date")
+    shift_hdr = _wo_proto(ws, "report_shift")
+    entry = _wo_proto(ws, "report_entry")
+
+    # מיזוגים סטטיים של התבנית, מלבד שורות צוות שממוזגות מחדש לכל הרוחב
+    for ref in layout["merged"]:
+        _, min_row, _, max_row_rng = range_boundaries(ref)
+        if not any(min_row <= r <= max_row_rng for r in team_by_row):
+            ws.merged_cells.add(ref)
+    for c in range(3, max_col + 1, 3):
+        ws.merged_cells.add(CellRange(min_col=c, min_row=HEADER_DATE_ROW,
+                                      max_col=c + 2, max_row=HEADER_DATE_ROW))
+    for r in team_by_row:
+        ws.merged_cells.add(CellRange(min_col=1, min_row=r, max_col=max_col, max_row=r))
+
+    for r in range(1, max_row + 1):
+        static = layout["rows"][r - 1]
+
+        if r in team_by_row:
+            tc = _wo_cell(ws, team, team_by_row[r])
+            # אותו תא "thick" משמש לכל התאים המכוסים — הכותב מעבד תא-תא ברצף
+            ws.append([tc] + [thick] * (max_col - 1))
+            continue
+
+        row = []
+        for src in static:
+            if not src:
+                row.append(plain)
+                continue
+            c = WriteOnlyCell(ws, src["value"])
+            c.font = src["font"]
+            c.fill = src["fill"]
+            c.alignment = src["alignment"]
+            c.protection = src["protection"]
+            c.number_format = src["number_format"]
+            c.border = BORDER_THIN
+            row.append(c)
+
+        if r == HEADER_DATE_ROW:
+            for d in days:
+                row += [_wo_cell(ws, date_hdr, d), plain, plain]
+        elif r == HEADER_SHIFT_ROW:
+            for _ in days:
+                row += [_wo_cell(ws, shift_hdr, f"משמרת {shift}") for shift in SHIFT_TYPES]
+        else:
+            for col in range(3, max_col + 1):
+                text = cells.get((r, col))
+                row.append(_wo_cell(ws, entry, text) if text is not None else plain)
+
+        ws.append(row)
+
+    return wb
+
+def save_workbook_to_buffer(wb):
+    """
+    שומר את הדוח לזיכרון ומחזיר io.BytesIO; רק קובץ שעובר את
+    EXPORT_SPOOL_MAX_BYTES נשפך לדיסק (קובץ זמני אנונימי שנמחק לבד כשהתגובה
+    נסגרת — בלי שאריות ב-/tmp).
+    SpooledTemporaryFile לא מוחזר כמו שהוא: werkzeug לא יודע את הגודל שלו
+    (אין Content-Length), ו-fileno() — ש-gunicorn בודק בשביל sendfile — מעביר
+    אותו לדיסק גם כשהוא קטן.
+    """
+    buf = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES, suffix=".xlsx")
+    try:
+        with span("workbook_save", source="export"):
+            wb.save(buf)
+        size = buf.tell()
+        buf.seek(0)
+        if size <= EXPORT_SPOOL_MAX_BYTES:
+            # לא עבר את הסף — עדיין בזיכרון
+            with buf:
+                return io.BytesIO(buf.read())
+    except Exception:
+        buf.close()
+        raise
+    return buf
+
+def send_export(buf):
+    resp = send_file(buf, as_attachment=True, download_name="hours_report.xlsx")
+    if resp.content_length is None:
+        # קובץ שנשפך לדיסק — werkzeug יודע לחשב גודל רק ל-BytesIO
+        buf.seek(0, os.SEEK_END)
+        resp.content_length = buf.tell()
+        buf.seek(0)
+    return resp
+
+def parse_export_request(data):
+    """
+    בדיקת גוף בקשת ייצוא (משותף ל-/export ול-/export/jobs).
+    מחזיר (params, None) או (None, error_response)
+    """
+    # --- validate input ---
+    try:
+        report_from = _parse_date(data["report_from"])
+        report_to = _parse_date(data["report_to"])
+    except Exception:
+        return None, (jsonify({"error": "report_from/report_to invalid. expected YYYY-MM-DD"}), 400)
+
+    if report_to < report_from:
+        return None, (jsonify({"error": "טווח תאריכים לא תקין: 'עד' קטן מ-'מדוח'"}), 400)
 
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-    path = tmp.name
-    tmp.close()
-    wb.save(path)
+    engine = data.get("engine") or request.args.get("engine") or "template"
+    if engine not in EXPORT_ENGINES:
+        return None, (jsonify({"error": f"unknown export engine: {engine}"}), 400)
+
+    source = data.get("source") or "client"
+    if source not in EXPORT_SOURCES:
+        return None, (jsonify({"error": f"unknown export source: {source}"}), 400)
+
+    if source == "server":
+        entries = load_entries_range(report_from, report_to)
+    else:
+        entries = data.get("entries", [])
+    if not entries:
+        return None, (jsonify({"error": "no entries to export"}), 400)
+
+    return {
+        "report_from": report_from,
+        "report_to": report_to,
+        "engine": engine,
+        "source": source,
+        "entries": entries,
+    }, None
+
+def export_profile_params(params):
+    # מה שנשמר עם פרופיל של ייצוא (build_export מוסיף את מידות הגיליון)
+    return {
+        "report_from": params["report_from"].isoformat(),
+        "report_to": params["report_to"].isoformat(),
+        "entries": len(params["entries"]),
+        "engine": params["engine"],
+        "source": params["source"],
+    }
+
+def build_export(params):
+    roster = get_roster()
+    cells = resolve_export_cells(
+        params["report_from"], params["report_to"], params["entries"], roster["emp_row"]
+    )
+    days = (params["report_to"] - params["report_from"]).days + 1
+    profile_note(employees=len(roster["emp_row"]), cells=len(cells), sheet_cols=2 + 3 * days)
+
+    build = build_export_stream if params["engine"] == "stream" else build_export_template
+    wb = build(params["report_from"], params["report_to"], cells, roster["team_rows"])
+
+    return save_workbook_to_buffer(wb)
+
+@app.post("/export")
+@login_required
+@profiled("/export")
+def export():
+    params, error = parse_export_request(request.json or {})
+    if error:
+        return error
+    profile_note(**export_profile_params(params))
+
+    buf = build_export(params)
 
     # ✅ no duplicate "export excel" lines (update_state already logs action_name)
     update_state("export excel")
 
-    @after_this_request
-    def cleanup(resp):
-        safe_remove(path)
-        return resp
+    return send_export(buf)
+
+# ================= EXPORT JOBS =================
+# ייצוא ארוך רץ ברקע כדי לא להחזיק worker של Flask לכל משך בניית הקובץ
+EXPORT_JOB_WORKERS = int(os.environ.get("EXPORT_JOB_WORKERS", "2"))
+EXPORT_JOB_QUEUE_MAX = 8          # עבודות בתור/בריצה
+EXPORT_JOB_TTL = 15 * 60          # שניות לשמירת תוצאה שהסתיימה
+
+# ב-MULTIPROCESS בקשת status/download יכולה להגיע ל-worker אחר — העבודות נשמרות
+# גם בדיסק: <id>.json (מצב) ו-<id>.xlsx (תוצאה)
+EXPORT_JOBS_DIR = os.path.join(APP_DIR, "data", "export_jobs")
 
-    return send_file(path, as_attachment=True, download_name="hours_report.xlsx")
+_export_pool = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS, thread_name_prefix="export")
+_export_jobs = {}
+_export_jobs_lock = threading.Lock()
+
+def _export_job_path(job_id, ext):
+    return os.path.join(EXPORT_JOBS_DIR, f"{job_id}.{ext}")
+
+def _persist_export_job(job):
+    if not MULTIPROCESS:
+        return
+    if job["result"] is not None:
+        # קודם התוצאה ואז המצב — "done" בדיסק תמיד עם קובץ מלא
+        path = _export_job_path(job["id"], "xlsx")
+        with open(path + ".tmp", "wb") as f:
+            f.write(job["result"])
+        os.replace(path + ".tmp", path)
+    _json_save_atomic(
+        _export_job_path(job["id"], "json"),
+        {k: v for k, v in job.items() if k != "result"}
+    )
+
+def _load_export_job(job_id):
+    # job_id מגיע מה-URL — רק hex של uuid4
+    if len(job_id) != 32 or any(c not in "0123456789abcdef" for c in job_id):
+        return None
+    try:
+        job = _json_load(_export_job_path(job_id, "json"))
+    except ValueError:
+        return None
+    return dict(job, result=None) if job else None
+
+def _purge_export_jobs():
+    cutoff = time.time() - EXPORT_JOB_TTL
+    with _export_jobs_lock:
+        for job_id in [k for k, j in _export_jobs.items()
+                       if j["finished_at"] and j["finished_at"] < cutoff]:
+            del _export_jobs[job_id]
+
+    if MULTIPROCESS and os.path.isdir(EXPORT_JOBS_DIR):
+        for name in os.listdir(EXPORT_JOBS_DIR):
+            job_id, ext = os.path.splitext(name)
+            if ext != ".json":
+                continue
+            job = _load_export_job(job_id)
+            if job and job["finished_at"] and job["finished_at"] < cutoff:
+                safe_remove(_export_job_path(job_id, "xlsx"))
+                safe_remove(_export_job_path(job_id, "json"))
+
+def _run_export_job(job_id, params):
+    with _export_jobs_lock:
+        job = _export_jobs[job_id]
+        job["status"] = "running"
+    _persist_export_job(job)
+    try:
+        # טווחים ארוכים עוברים דרך כאן (לא דרך /export) — נמדדים באותו סף
+        with profile_block("/export/jobs", job["user"], job_id=job_id, **export_profile_params(params)):
+            buf = build_export(params)
+        with buf:
+            result, error, status = buf.read(), None, "done"
+    except Exception as ex:
+        result, error, status = None, str(ex), "error"
+    with _export_jobs_lock:
+        job = _export_jobs[job_id]
+        job.update(status=status, result=result, error=error, finished_at=time.time())
+    _persist_export_job(job)
+
+def _get_export_job(job_id):
+    _purge_export_jobs()
+    with _export_jobs_lock:
+        job = _export_jobs.get(job_id)
+    if not job and MULTIPROCESS:
+        job = _load_export_job(job_id)
+    if not job:
+        abort(404)
+    if job["user"] != session.get("user") and session.get("role") != "admin":
+        abort(403)
+    return job
+
+@app.post("/export/jobs")
+@login_required
+def export_job_submit():
+    params, error = parse_export_request(request.json or {})
+    if error:
+        return error
+
+    _purge_export_jobs()
+    with _export_jobs_lock:
+        active = sum(1 for j in _export_jobs.values() if j["status"] in ("queued", "running"))
+        if active >= EXPORT_JOB_QUEUE_MAX:
+            return jsonify({"error": "too many exports in progress, try again shortly"}), 429
+
+        job_id = uuid.uuid4().hex
+        _export_jobs[job_id] = {
+            "id": job_id,
+            "user": session.get("user"),
+            "status": "queued",
+            "created_at": time.time(),
+            "finished_at": None,
+            "error": None,
+            "result": None,
+        }
+        job = _export_jobs[job_id]
+
+    _persist_export_job(job)
+    _export_pool.submit(_run_export_job, job_id, params)
+
+    return jsonify({
+        "job_id": job_id,
+        "status_url": url_for("export_job_status", job_id=job_id),
+        "download_url": url_for("export_job_download", job_id=job_id),
+    }), 202
+
+@app.get("/export/<job_id>/status")
+@login_required
+def export_job_status(job_id):
+    job = _get_export_job(job_id)
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "error": job["error"],
+    })
+
+@app.get("/export/<job_id>/download")
+@login_required
+def export_job_download(job_id):
+    job = _get_export_job(job_id)
+    if job["status"] != "done":
+        return jsonify({"error": f"export is {job['status']}"}), 409
+
+    update_state("export excel")
+
+    if job["result"] is None:
+        # נוצרה ב-worker אחר
+        return send_file(_export_job_path(job["id"], "xlsx"), as_attachment=True, download_name="hours_report.xlsx")
+    return send_file(io.BytesIO(job["result"]), as_attachment=True, download_name="hours_report.xlsx")
 
 
 def is_marked_as_done(cell) -> bool:
@@ -776,15 +1908,10 @@ PAYROLL_ORANGE_RGB = {
     "FFED7D31",  # Custom orange
 }
 
-def is_payroll_done_cell(cell) -> bool:
-    fill = cell.fill
+def is_payroll_done_fill(fill) -> bool:
     if not fill or fill.patternType != "solid":
         return False
 
-    # חייב להיות ערך בתא
-    if not cell.value or not str(cell.value).strip():
-        return False
-
     fg = fill.fgColor
     if not fg:
         return False
@@ -801,6 +1928,32 @@ def is_payroll_done_cell(cell) -> bool:
     # ✅ כל צבע אחר (כולל THEME) נחשב שכר
     return True
 
+def _has_value(cell) -> bool:
+    # חייב להיות ערך בתא
+    return bool(cell.value and str(cell.value).strip())
+
+def make_payroll_done_classifier():
+    """
+    תא "דווח לשכר" = is_payroll_done_fill על ה-fill + ערך בתא, עם מטמון לסריקת גיליון שלם:
+    ההחלטה על ה-fill מחושבת פעם אחת לכל style id של הגיליון
+    (בדרך כלל יש רק כמה בודדים), ולכל תא נשאר רק lookup + בדיקת ערך.
+    """
+    by_style = {}
+
+    def classify(cell) -> bool:
+        style_id = getattr(cell, "_style_id", None)
+        if style_id is None:
+            # EMPTY_CELL — אין fill
+            return False
+
+        done_fill = by_style.get(style_id)
+        if done_fill is None:
+            done_fill = by_style[style_id] = is_payroll_done_fill(cell.fill)
+
+        return done_fill and _has_value(cell)
+
+    return classify
+
 def _to_date_iso(v):
     # header date cell יכול להיות date/datetime/str
     if isinstance(v, dt.datetime):
@@ -817,31 +1970,31 @@ def _to_date_iso(v):
             pass
     return None
 
-def build_col_meta_from_export(ws):
+def build_col_meta(date_values, shift_values):
     """
-    קורא את האקסל 'המטריצי' שיוצא מהמערכת:
-    - תאריך בשורה HEADER_DATE_ROW (4) עם מיזוגים
-    - משמרת בשורה HEADER_SHIFT_ROW (5)
+    קורא את שורות הכותרת של האקסל 'המטריצי' שיוצא מהמערכת:
+    - date_values: ערכי שורה HEADER_DATE_ROW (4) — תאריך עם מיזוגים
+    - shift_values: ערכי שורה HEADER_SHIFT_ROW (5)
+    (אינדקס 0 = עמודה 1)
     מחזיר dict: {col_index: (date_iso, shift_name)}
     """
     meta = {}
+    last_dv = None
 
-    for col in range(3, ws.max_column + 1):
-        # date: לפעמים הערך נמצא רק בעמודה הראשונה של המיזוג
-        dv = ws.cell(HEADER_DATE_ROW, col).value
-        if not dv:
-            # נלך שמאלה עד שנמצא ערך (כדי להתמודד עם merged header)
-            c = col
-            while c >= 3 and not ws.cell(HEADER_DATE_ROW, c).value:
-                c -= 1
-            dv = ws.cell(HEADER_DATE_ROW, c).value if c >= 3 else None
+    for col in range(3, max(len(date_values), len(shift_values)) + 1):
+        dv = date_values[col - 1] if col <= len(date_values) else None
+        if dv:
+            last_dv = dv
+        else:
+            # merged header: הערך נמצא רק בעמודה הראשונה של המיזוג → האחרון משמאל
+            dv = last_dv
 
         date_iso = _to_date_iso(dv)
         if not date_iso:
             continue
 
-        sv = ws.cell(HEADER_SHIFT_ROW, col).value or ""
-        sv = str(sv).strip()
+        sv = shift_values[col - 1] if col <= len(shift_values) else None
+        sv = str(sv or "").strip()
         # מצפה ל"משמרת בוקר" / "משמרת ערב" / "משמרת לילה"
         shift = sv.replace("משמרת", "").replace("\xa0", " ").strip() if sv else ""
         if not shift:
@@ -851,34 +2004,710 @@ def build_col_meta_from_export(ws):
 
     return meta
 
-def is_team_row(ws, row):
-    # אם השורה ממוזגת לרוחב => זו שורת צוות
+_SHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+
+def read_merged_ranges(ws):
+    """
+    בגיליון read-only אין ws.merged_cells — קוראים את <mergeCell> ישירות
+    מה-XML של הגיליון. ב-XML המיזוגים באים אחרי sheetData, אז זה מעבר נוסף
+    על הקובץ לפני iter_rows() (שורות הנתונים נזרקות תוך כדי, כך שהזיכרון לא
+    תלוי בגודל הגיליון — אבל ה-XML נקרא פעמיים).
+    ws._get_source() פרטי ב-openpyxl — הגרסה נעולה ב-requirements.txt.
+    מחזיר:
+    - merged_rows: set של שורות ממוזגות לרוחב (כמו build_merged_row_index)
+    - covered: {row: [(min_col, max_col)]} — תאים שמכוסים במיזוג (לא תא העוגן),
+      שבמצב עריכה openpyxl מרוקן אותם
+    """
+    merged_rows = set()
+    covered = {}
     try:
-        return any(rng.min_row == row and rng.max_row == row for rng in ws.merged_cells.ranges)
+        with ws._get_source() as src:
+            for _, el in ET.iterparse(src):
+                if el.tag == _SHEET_NS + "row":
+                    el.clear()
+                elif el.tag == _SHEET_NS + "mergeCell":
+                    min_col, min_row, max_col, max_row = range_boundaries(el.get("ref"))
+                    if min_row == max_row:
+                        merged_rows.add(min_row)
+                    if min_col < max_col:
+                        covered.setdefault(min_row, []).append((min_col + 1, max_col))
+                    for r in range(min_row + 1, max_row + 1):
+                        covered.setdefault(r, []).append((min_col, max_col))
     except Exception:
-        return False
-PAYROLL_STATUS_PATH = os.path.join(APP_DIR, "data", "payroll_status.json")
+        # בלי המיזוגים שורות צוות לא מדולגות ותאים מכוסים לא מרוקנים —
+        # עדיף להיכשל (400 בהעלאה) מאשר לסמן שכר לפי קריאה שגויה
+        app.logger.exception("failed to read merged ranges from payroll sheet")
+        raise
+    return merged_rows, covered
 
-def load_payroll_status():
-    if not os.path.exists(PAYROLL_STATUS_PATH):
+def _row_cell(cells, col):
+    return cells[col - 1] if col <= len(cells) else EMPTY_CELL
+
+def iter_payroll_sheet(ws, col_meta):
+    """
+    מעבר יחיד קדימה על השורות של גיליון read-only (אחרי קריאת המיזוגים ב-
+    read_merged_ranges) — בזיכרון יש בכל רגע שורה אחת.
+    ממלא את col_meta ({col: (date_iso, shift)}) משורות הכותרת,
+    ואז מניב לכל שורת עובד: (row, name, cells)
+    """
+    merged_rows, covered = read_merged_ranges(ws)
+    date_values = ()
+
+    for r, cells in enumerate(ws.iter_rows(), start=1):
+        if r in covered:
+            cells = list(cells)
+            for c1, c2 in covered[r]:
+                for c in range(c1, min(c2, len(cells)) + 1):
+                    cells[c - 1] = EMPTY_CELL
+
+        if r == HEADER_DATE_ROW:
+            date_values = [c.value for c in cells]
+        elif r == HEADER_SHIFT_ROW:
+            col_meta.update(build_col_meta(date_values, [c.value for c in cells]))
+
+        # עובדים החל מ-EMP_START_ROW
+        if r < EMP_START_ROW or is_team_row(merged_rows, r):
+            continue
+
+        name = _row_cell(cells, NAME_COL).value
+        emp_id = _row_cell(cells, ID_COL).value
+
+        if not name or not emp_id:
+            continue
+
+        yield r, str(name).strip(), cells
+
+PAYROLL_STATUS_PATH = os.path.join(APP_DIR, "data", "payroll_status.json")
+ENTRIES_PATH = os.path.join(APP_DIR, "data", "entries.json")
+
+# ================= STORAGE =================
+# touch_log / payroll_status / payroll_meta / entries נשמרים באחד מה-backends:
+# - "json" (ברירת מחדל): קבצים ב-data/ — כל שמירה כותבת את כל הקובץ מחדש
+# - "sqlite": data/shiftchange.db במצב WAL — שמירה כותבת רק את הרשומות שהשתנו.
+#   בפתיחה הראשונה קבצי ה-JSON הקיימים מועברים אליו (פעם אחת).
+# - "journal": כמו json, אבל touch_log נשמר כ-snapshot (touch_log.json)
+#   + יומן הוספה בלבד (touch_log.journal) שמקופל ל-snapshot כשהוא גדל.
+STORAGE_BACKEND = os.environ.get("SHIFTCHANGE_STORAGE", "json")
+DB_PATH = os.path.join(APP_DIR, "data", "shiftchange.db")
+TOUCH_JOURNAL_PATH = os.path.join(APP_DIR, "data", "touch_log.journal")
+TOUCH_JOURNAL_COMPACT_BYTES = 2 * 1024 * 1024
+
+# kind — תווית קבועה ל-/metrics (touch_log, payroll_status, ...); לא שם הקובץ,
+# כדי שקבצים עם id (פרופיילים, עבודות ייצוא) לא ייצרו סדרה חדשה כל אחד
+def _json_load(path, kind="other"):
+    if not os.path.exists(path):
         return {}
-    with open(PAYROLL_STATUS_PATH, "r", encoding="utf-8") as f:
+    with span("json_load", file=kind), open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def save_payroll_status(data):
-    os.makedirs(os.path.dirname(PAYROLL_STATUS_PATH), exist_ok=True)
-    with open(PAYROLL_STATUS_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def _json_save_atomic(path, data, kind="other"):
+    # כתיבה לקובץ זמני באותה תיקייה ואז rename — קורא לעולם לא רואה קובץ חצי כתוב
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with span("json_save", file=kind), os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    except Exception:
+        safe_remove(tmp)
+        raise
+
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS touch_log (
+    key TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    name TEXT NOT NULL,
+    shift TEXT NOT NULL,
+    touched_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS touch_log_dns ON touch_log (date, name, shift);
+CREATE INDEX IF NOT EXISTS touch_log_touched_at ON touch_log (touched_at);
+
+CREATE TABLE IF NOT EXISTS payroll_status (
+    key TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    name TEXT NOT NULL,
+    shift TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payroll_status_dns ON payroll_status (date, name, shift);
+
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    name TEXT NOT NULL,
+    shift TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_date ON entries (date);
+
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_initialized = False
+
+def get_db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+        _init_db(conn)
+    return conn
+
+@contextmanager
+def db_transaction():
+    conn = get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        # מונה גרסה — כל כתיבה מקדמת אותו (ראה storage_version)
+        conn.execute(
+            "INSERT INTO kv (key, value) VALUES ('version', '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def _init_db(conn):
+    global _db_initialized
+    with _db_init_lock:
+        if _db_initialized:
+            return
+        conn.executescript(_DB_SCHEMA)
+        migrate_json_to_sqlite(conn)
+        _db_initialized = True
+
+def migrate_json_to_sqlite(conn):
+    """
+    העברה חד-פעמית של קבצי ה-JSON הקיימים ל-SQLite.
+    הקבצים עצמם נשארים במקומם (גיבוי); הדגל ב-kv מונע העברה כפולה.
+    """
+    _journal_fold()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM kv WHERE key = 'json_migrated'").fetchone():
+            conn.execute("ROLLBACK")
+            return
+        _db_put_touch_log(conn, _json_load(TOUCH_LOG_PATH, "touch_log"))
+        _db_put_payroll_status(conn, _json_load(PAYROLL_STATUS_PATH, "payroll_status"))
+        _db_put_entries(conn, _json_load(ENTRIES_PATH, "entries"))
+        meta = _json_load(PAYROLL_META_PATH, "payroll_meta")
+        if meta:
+            _db_put_kv(conn, "payroll_meta", meta)
+        _db_put_kv(conn, "json_migrated", dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def split_key(key):
+    # "date|name|shift" → (date, name, shift)
+    date, _, rest = key.partition("|")
+    name, _, shift = rest.rpartition("|")
+    return date, name, shift
+
+def _db_put_touch_log(conn, changes):
+    conn.executemany(
+        "INSERT OR REPLACE INTO touch_log (key, date, name, shift, touched_at, data) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(k, *split_key(k), rec.get("touched_at"), json.dumps(rec, ensure_ascii=False))
+         for k, rec in changes.items()]
+    )
+
+def _db_put_payroll_status(conn, changes):
+    conn.executemany(
+        "INSERT OR REPLACE INTO payroll_status (key, date, name, shift, data) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [(k, *split_key(k), json.dumps(rec, ensure_ascii=False))
+         for k, rec in changes.items()]
+    )
+
+def _db_put_entries(conn, changes):
+    # rec None = מחיקה
+    conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k, rec in changes.items() if rec is None])
+    conn.executemany(
+        "INSERT OR REPLACE INTO entries (key, date, name, shift, data) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [(k, *split_key(k), json.dumps(rec, ensure_ascii=False))
+         for k, rec in changes.items() if rec is not None]
+    )
+
+def _db_put_kv(conn, key, value):
+    conn.execute(
+        "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+        (key, json.dumps(value, ensure_ascii=False))
+    )
+
+def _db_get_kv(key, default=None):
+    row = get_db().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def _db_get_by_keys(table, keys):
+    # רק הרשומות של המפתחות המבוקשים (שקיימות); IN ב-chunks בגלל מגבלת הפרמטרים
+    found = {}
+    conn = get_db()
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        rows = conn.execute(
+            f"SELECT key, data FROM {table} WHERE key IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+        found.update((k, json.loads(v)) for k, v in rows)
+    return found
+
+def _db_load_map(table):
+    rows = get_db().execute(f"SELECT key, data FROM {table}")
+    return {k: json.loads(v) for k, v in rows}
+
+# --- touch_log journal ---
+# מצב הזיכרון: snapshot + היומן עד offset מסוים. קריאה חוזרת קוראת רק את
+# מה שנוסף ליומן מאז, כל עוד ה-snapshot לא הוחלף.
+_journal_lock = threading.Lock()
+_journal_cache = {"snapshot_key": None, "offset": 0, "data": {}}
+
+def _journal_apply(data, chunk):
+    """
+    מחיל שורות יומן שלמות על data; מחזיר כמה בתים נצרכו
+    (שורה אחרונה בלי סוף שורה — כתיבה שעדיין באמצע — נשארת לפעם הבאה).
+    """
+    used = 0
+    for line in chunk.splitlines(keepends=True):
+        if not line.endswith(b"\n"):
+            break
+        used += len(line)
+        try:
+            rec = json.loads(line)
+            data[rec["key"]] = rec["entry"]
+        except Exception:
+            continue
+    return used
+
+def _journal_state():
+    # נקרא תחת _journal_lock
+    snapshot_key = _file_key(TOUCH_LOG_PATH)
+    cache = _journal_cache
+    if cache["snapshot_key"] != snapshot_key:
+        cache.update(snapshot_key=snapshot_key, offset=0, data=_json_load(TOUCH_LOG_PATH, "touch_log"))
+
+    try:
+        with open(TOUCH_JOURNAL_PATH, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < cache["offset"]:
+                # היומן קוצר (compaction בתהליך אחר) — בונים מחדש
+                cache.update(offset=0, data=_json_load(TOUCH_LOG_PATH, "touch_log"))
+            f.seek(cache["offset"])
+            cache["offset"] += _journal_apply(cache["data"], f.read())
+    except FileNotFoundError:
+        pass
+    return cache["data"]
+
+def _journal_append(changes):
+    lines = "".join(
+        json.dumps({"key": k, "entry": rec}, ensure_ascii=False, separators=(",", ":")) + "\n"
+        for k, rec in changes.items()
+    )
+    os.makedirs(os.path.dirname(TOUCH_JOURNAL_PATH), exist_ok=True)
+    with file_lock("touch_log"), _journal_lock:
+        with open(TOUCH_JOURNAL_PATH, "a", encoding="utf-8") as f:
+            f.write(lines)
+        if os.path.getsize(TOUCH_JOURNAL_PATH) > TOUCH_JOURNAL_COMPACT_BYTES:
+            _journal_compact()
+
+def _journal_compact():
+    """
+    מקפל את היומן ל-snapshot חדש (כתיבה אטומית) ומרוקן את היומן.
+    אם נפלנו בין שני השלבים — הפעלה חוזרת של היומן על ה-snapshot החדש לא משנה כלום.
+    """
+    data = _journal_state()
+    _json_save_atomic(TOUCH_LOG_PATH, data, "touch_log")
+    with open(TOUCH_JOURNAL_PATH, "w", encoding="utf-8"):
+        pass
+    _journal_cache.update(snapshot_key=_file_key(TOUCH_LOG_PATH), offset=0)
+
+def _journal_fold():
+    """
+    יומן שנשאר מהרצה קודמת על backend journal — מקפלים ל-snapshot ומוחקים,
+    לפני ש-json/sqlite קוראים את touch_log.json. אחרת הנגיעות שמאז ה-compaction
+    האחרון נעלמות, וחזרה ל-journal מריצה את היומן הישן מעל ערכים חדשים יותר.
+    """
+    if not os.path.exists(TOUCH_JOURNAL_PATH):
+        return
+    with file_lock("touch_log"), _journal_lock:
+        if not os.path.exists(TOUCH_JOURNAL_PATH):
+            return
+        _journal_compact()
+        safe_remove(TOUCH_JOURNAL_PATH)
+        _journal_cache.update(snapshot_key=None, offset=0, data={})
+
+# --- touch_log ---
 def load_touch_log():
-    if not os.path.exists(TOUCH_LOG_PATH):
-        return {}
-    with open(TOUCH_LOG_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+    if STORAGE_BACKEND == "sqlite":
+        return _db_load_map("touch_log")
+    if STORAGE_BACKEND == "journal":
+        with _journal_lock:
+            return dict(_journal_state())
+    _journal_fold()
+    return _json_load(TOUCH_LOG_PATH, "touch_log")
 
 def save_touch_log(data):
-    os.makedirs(os.path.dirname(TOUCH_LOG_PATH), exist_ok=True)
-    with open(TOUCH_LOG_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    if STORAGE_BACKEND == "sqlite":
+        with db_transaction() as conn:
+            conn.execute("DELETE FROM touch_log")
+            _db_put_touch_log(conn, data)
+        return
+    with file_lock("touch_log"):
+        if STORAGE_BACKEND == "journal":
+            with _journal_lock:
+                _json_save_atomic(TOUCH_LOG_PATH, data, "touch_log")
+                safe_remove(TOUCH_JOURNAL_PATH)
+                _journal_cache.update(snapshot_key=None, offset=0, data={})
+            return
+        _json_save_atomic(TOUCH_LOG_PATH, data, "touch_log")
+
+def get_touch_entries(keys):
+    # רק הרשומות של המפתחות המבוקשים (שקיימות)
+    keys = list(dict.fromkeys(keys))
+    if STORAGE_BACKEND == "sqlite":
+        return _db_get_by_keys("touch_log", keys)
+    if STORAGE_BACKEND == "journal":
+        with _journal_lock:
+            touch_log = _journal_state()
+            return {k: touch_log[k] for k in keys if k in touch_log}
+    touch_log = load_touch_log()
+    return {k: touch_log[k] for k in keys if k in touch_log}
+
+def update_touch_log(changes):
+    if not changes:
+        return
+    if STORAGE_BACKEND == "sqlite":
+        with db_transaction() as conn:
+            _db_put_touch_log(conn, changes)
+        return
+    with file_lock("touch_log"):
+        old_version = _touch_log_version()
+        if STORAGE_BACKEND == "journal":
+            _journal_append(changes)
+        else:
+            touch_log = load_touch_log()
+            touch_log.update(changes)
+            save_touch_log(touch_log)
+        _touch_order_apply(changes, old_version, _touch_log_version())
+
+# --- touch_log ordered by touched_at ---
+# ב-json/journal: רשימה ממוינת (touched_at, key) שנבנית כשהקובץ משתנה מבחוץ
+# ומתעדכנת במקום בכל שמירה מהתהליך הזה. ב-sqlite: האינדקס על touched_at.
+_touch_order_lock = threading.Lock()
+_touch_order = {"version": False, "data": {}, "times": [], "keys": []}
+
+def _touch_log_version():
+    if STORAGE_BACKEND == "journal":
+        return (_file_key(TOUCH_LOG_PATH), _file_key(TOUCH_JOURNAL_PATH))
+    return _file_key(TOUCH_LOG_PATH)
+
+def _touch_order_current():
+    # נקרא תחת _touch_order_lock
+    version = _touch_log_version()
+    if _touch_order["version"] != version:
+        data = load_touch_log()
+        order = sorted((rec.get("touched_at") or "", k) for k, rec in data.items())
+        _touch_order.update(
+            version=version,
+            data=data,
+            times=[t for t, _ in order],
+            keys=[k for _, k in order],
+        )
+    return _touch_order
+
+def _touch_order_apply(changes, old_version, new_version):
+    with _touch_order_lock:
+        view = _touch_order
+        if view["version"] != old_version:
+            # לא היה עדכני ממילא — ייבנה מחדש בקריאה הבאה
+            return
+        times, keys, data = view["times"], view["keys"], view["data"]
+        for k, rec in changes.items():
+            old = data.get(k)
+            if old is not None:
+                i = bisect_left(times, old.get("touched_at") or "")
+                while keys[i] != k:
+                    i += 1
+                del times[i]
+                del keys[i]
+            t = rec.get("touched_at") or ""
+            i = bisect_right(times, t)
+            times.insert(i, t)
+            keys.insert(i, k)
+            data[k] = rec
+        view["version"] = new_version
+
+def touch_log_since(ts, inclusive=False):
+    """
+    רשומות touch_log עם touched_at אחרי ts (או שווה, אם inclusive),
+    כרשימת (key, entry) בסדר touched_at עולה.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        op = ">=" if inclusive else ">"
+        rows = get_db().execute(
+            f"SELECT key, data FROM touch_log WHERE touched_at {op} ? ORDER BY touched_at",
+            (ts,)
+        )
+        return [(k, json.loads(v)) for k, v in rows]
+
+    with _touch_order_lock:
+        view = _touch_order_current()
+        i = (bisect_left if inclusive else bisect_right)(view["times"], ts)
+        return [(k, view["data"][k]) for k in view["keys"][i:]]
+
+# --- payroll_status ---
+def load_payroll_status():
+    if STORAGE_BACKEND == "sqlite":
+        return _db_load_map("payroll_status")
+    return _json_load(PAYROLL_STATUS_PATH, "payroll_status")
+
+def save_payroll_status(data):
+    if STORAGE_BACKEND == "sqlite":
+        with db_transaction() as conn:
+            conn.execute("DELETE FROM payroll_status")
+            _db_put_payroll_status(conn, data)
+        return
+    with file_lock("payroll_status"):
+        _json_save_atomic(PAYROLL_STATUS_PATH, data, "payroll_status")
+
+def update_payroll_status(changes):
+    if STORAGE_BACKEND == "sqlite":
+        with db_transaction() as conn:
+            _db_put_payroll_status(conn, changes)
+        return
+    with file_lock("payroll_status"):
+        old_key = _file_key(PAYROLL_STATUS_PATH)
+        payroll = load_payroll_status()
+        payroll.update(changes)
+        save_payroll_status(payroll)
+        _payroll_index_apply(changes, old_key, _file_key(PAYROLL_STATUS_PATH))
+
+def get_payroll_entries(keys):
+    # רק הרשומות של המפתחות המבוקשים (שקיימות)
+    keys = list(dict.fromkeys(keys))
+    if STORAGE_BACKEND == "sqlite":
+        return _db_get_by_keys("payroll_status", keys)
+    payroll = load_payroll_status()
+    return {k: payroll[k] for k in keys if k in payroll}
+
+def payroll_status_since(version=None, date_from=None, date_to=None):
+    """
+    רשומות שכר עם version גדול מ-version (None = הכל), אופציונלית רק
+    בטווח תאריכים [date_from, date_to] (מחרוזות ISO).
+    """
+    if STORAGE_BACKEND == "sqlite":
+        sql = "SELECT key, data FROM payroll_status WHERE 1 = 1"
+        args = []
+        if version is not None:
+            sql += " AND json_extract(data, '$.version') > ?"
+            args.append(version)
+        if date_from:
+            sql += " AND date >= ?"
+            args.append(date_from)
+        if date_to:
+            sql += " AND date <= ?"
+            args.append(date_to)
+        return {k: json.loads(v) for k, v in get_db().execute(sql, args)}
+
+    found = {}
+    for k, rec in load_payroll_status().items():
+        if version is not None and rec.get("version", 0) <= version:
+            continue
+        date = k.partition("|")[0]
+        if (date_from and date < date_from) or (date_to and date > date_to):
+            continue
+        found[k] = rec
+    return found
+
+def count_payroll_status():
+    if STORAGE_BACKEND == "sqlite":
+        return get_db().execute("SELECT COUNT(*) FROM payroll_status").fetchone()[0]
+    return len(load_payroll_status())
+
+# --- payroll (date, name) index ---
+# מחליף את any(k.startswith(f"{date}|{name}|") ...) על כל מפתחות השכר.
+# ב-json/journal האינדקס נבנה בטעינה (לפי mtime של הקובץ) ומתעדכן בהעלאת שכר;
+# ב-sqlite זו שאילתה על האינדקס (date, name, shift).
+_payroll_index_lock = threading.Lock()
+_payroll_index = {"key": False, "index": {}}
+
+def _payroll_index_add(index, key, rec):
+    date, name, shift = split_key(key)
+    index.setdefault(date, {}).setdefault(name, {})[shift] = bool(rec.get("done"))
+
+def payroll_day_index():
+    """date → {name: {shift: done}}"""
+    key = _file_key(PAYROLL_STATUS_PATH)
+    with _payroll_index_lock:
+        if _payroll_index["key"] != key:
+            index = {}
+            for k, rec in _json_load(PAYROLL_STATUS_PATH, "payroll_status").items():
+                _payroll_index_add(index, k, rec)
+            _payroll_index.update(key=key, index=index)
+        return _payroll_index["index"]
+
+def _payroll_index_apply(changes, old_key, new_key):
+    with _payroll_index_lock:
+        if _payroll_index["key"] != old_key:
+            # האינדקס לא היה עדכני ממילא — ייבנה מחדש בקריאה הבאה
+            return
+        for k, rec in changes.items():
+            _payroll_index_add(_payroll_index["index"], k, rec)
+        _payroll_index["key"] = new_key
+
+def payroll_has_day(date, name):
+    # האם קיים סטטוס שכר כלשהו לעובד בתאריך (בכל משמרת)
+    if STORAGE_BACKEND == "sqlite":
+        row = get_db().execute(
+            "SELECT 1 FROM payroll_status WHERE date = ? AND name = ? LIMIT 1",
+            (date, name)
+        ).fetchone()
+        return row is not None
+    return name in payroll_day_index().get(date, {})
+
+def payroll_done_names(date):
+    # עובדים עם משמרת אחת לפחות שדווחה לשכר בתאריך
+    if STORAGE_BACKEND == "sqlite":
+        rows = get_db().execute(
+            "SELECT DISTINCT name FROM payroll_status WHERE date = ? AND json_extract(data, '$.done')",
+            (date,)
+        )
+        return {name for (name,) in rows}
+    by_name = payroll_day_index().get(date, {})
+    with _payroll_index_lock:
+        # _payroll_index_apply מעדכן את אותו dict במקום
+        return {name for name, shifts in by_name.items() if any(shifts.values())}
+
+# --- payroll_meta ---
+def load_payroll_meta():
+    if STORAGE_BACKEND == "sqlite":
+        return _db_get_kv("payroll_meta", {})
+    return _json_load(PAYROLL_META_PATH, "payroll_meta")
+
+def save_payroll_meta(data):
+    if STORAGE_BACKEND == "sqlite":
+        with db_transaction() as conn:
+            _db_put_kv(conn, "payroll_meta", data)
+        return
+    _json_save_atomic(PAYROLL_META_PATH, data, "payroll_meta")
+
+# --- entries ---
+# הרשומות עצמן (פעולה/הערה לכל date|name|shift), נשמרות ב-/touch — מקור
+# הנתונים לייצוא עם source="server". ב-json/journal: data/entries.json.
+def get_entries(keys):
+    # רק הרשומות של המפתחות המבוקשים (שקיימות)
+    keys = list(dict.fromkeys(keys))
+    if STORAGE_BACKEND == "sqlite":
+        return _db_get_by_keys("entries", keys)
+    entries = _json_load(ENTRIES_PATH, "entries")
+    return {k: entries[k] for k in keys if k in entries}
+
+def update_entries(changes):
+    """key → {"action", "note", "updated_at", "by"}; None מוחק את הרשומה"""
+    if not changes:
+        return
+    if STORAGE_BACKEND == "sqlite":
+        with db_transaction() as conn:
+            _db_put_entries(conn, changes)
+        return
+    with file_lock("entries"):
+        entries = _json_load(ENTRIES_PATH, "entries")
+        for k, rec in changes.items():
+            if rec is None:
+                entries.pop(k, None)
+            else:
+                entries[k] = rec
+        _json_save_atomic(ENTRIES_PATH, entries, "entries")
+
+def add_missing_entries(changes):
+    # כמו update_entries, אבל לא דורס מפתח שכבר קיים; מחזיר כמה נוספו
+    if not changes:
+        return 0
+    if STORAGE_BACKEND == "sqlite":
+        with db_transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO entries (key, date, name, shift, data) VALUES (?, ?, ?, ?, ?)",
+                [(k, *split_key(k), json.dumps(rec, ensure_ascii=False)) for k, rec in changes.items()]
+            )
+            return conn.total_changes - before
+    with file_lock("entries"):
+        entries = _json_load(ENTRIES_PATH, "entries")
+        added = {k: rec for k, rec in changes.items() if k not in entries}
+        if added:
+            entries.update(added)
+            _json_save_atomic(ENTRIES_PATH, entries, "entries")
+        return len(added)
+
+def load_entries_range(date_from, date_to):
+    """רשומות בטווח (כולל) בפורמט של גוף /export: date, name, shift, action, note"""
+    date_from, date_to = date_from.isoformat(), date_to.isoformat()
+    if STORAGE_BACKEND == "sqlite":
+        rows = get_db().execute(
+            "SELECT key, data FROM entries WHERE date BETWEEN ? AND ? ORDER BY date",
+            (date_from, date_to)
+        )
+        items = [(k, json.loads(v)) for k, v in rows]
+    else:
+        items = sorted(
+            (k, rec) for k, rec in _json_load(ENTRIES_PATH, "entries").items()
+            if date_from <= split_key(k)[0] <= date_to
+        )
+
+    out = []
+    for k, rec in items:
+        date, name, shift = split_key(k)
+        out.append({"date": date, "name": name, "shift": shift,
+                    "action": rec.get("action", ""), "note": rec.get("note", "")})
+    return out
+
+def storage_version():
+    """
+    גרסה זולה של מצב השכר/נגיעות (בלי לקרוא את הנתונים עצמם) — משתנה בכל כתיבה.
+    json/journal: mtime+size של הקבצים; sqlite: מונה ב-kv.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        return _db_get_kv("version", 0)
+    return (_touch_log_version(), _file_key(PAYROLL_STATUS_PATH), _file_key(PAYROLL_META_PATH))
+
+def reset_storage():
+    # מונה השינויים של השכר ממשיך לעלות גם אחרי איפוס; reset_version
+    # מסמן ללקוחות עם since ישן יותר שצריך סנכרון מלא
+    with _payroll_upload_lock, file_lock("payroll_upload"), \
+            file_lock("touch_log"), file_lock("payroll_status"), file_lock("entries"):
+        version = int(load_payroll_meta().get("version", 0)) + 1
+
+        with _journal_lock:
+            for p in (PAYROLL_STATUS_PATH, TOUCH_LOG_PATH, TOUCH_JOURNAL_PATH, PAYROLL_META_PATH, ENTRIES_PATH):
+                try:
+                    if os.path.exists(p):
+                        os.remove(p)
+                except Exception:
+                    pass
+            _journal_cache.update(snapshot_key=None, offset=0, data={})
+
+        if STORAGE_BACKEND == "sqlite":
+            with db_transaction() as conn:
+                conn.execute("DELETE FROM touch_log")
+                conn.execute("DELETE FROM payroll_status")
+                conn.execute("DELETE FROM entries")
+                conn.execute("DELETE FROM kv WHERE key = 'payroll_meta'")
+
+        save_payroll_meta({"version": version, "reset_version": version})
 
 def cell_fill_debug(cell) -> dict:
     """
@@ -902,8 +2731,11 @@ def cell_fill_debug(cell) -> dict:
 
 
 
+_payroll_upload_lock = threading.Lock()
+
 @app.route("/upload-payroll", methods=["POST"])
 @login_required
+@profiled("/upload-payroll")
 def upload_payroll():
     if session.get("role") != "admin":
         return jsonify({"error": "forbidden"}), 403
@@ -913,16 +2745,17 @@ def upload_payroll():
         return jsonify({"error": "missing file"}), 400
 
     try:
-        wb = openpyxl.load_workbook(file, data_only=False)
+        with span("workbook_load", source="payroll"):
+            wb = openpyxl.load_workbook(file, read_only=True, data_only=False)
         ws = wb.active
     except Exception as ex:
         return jsonify({"error": f"failed to read xlsx: {ex}"}), 400
+    profile_note(file=file.filename, sheet_rows=ws.max_row, sheet_cols=ws.max_column)
 
-    # col -> (date_iso, shift)
-    col_meta = build_col_meta_from_export(ws)
+    # col -> (date_iso, shift) — מתמלא מתוך שורות הכותרת בזמן המעבר
+    col_meta = {}
 
-    payroll = load_payroll_status()
-    touch_log = load_touch_log()
+    changes = {}
     now = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     by = session.get("user", "admin")
 
@@ -930,67 +2763,78 @@ def upload_payroll():
     scanned_cells = 0
     marked_cells = 0
     sample_printed = 0
+    is_done = make_payroll_done_classifier()
 
-    # עובדים החל מ-EMP_START_ROW
-    for r in range(EMP_START_ROW, ws.max_row + 1):
-        if is_team_row(ws, r):
-            continue
-
-        name = ws.cell(r, NAME_COL).value
-        emp_id = ws.cell(r, ID_COL).value
-
-        if not name or not emp_id:
-            continue
-
-        name = str(name).strip()
-
-        # עובר רק על עמודות דינמיות שיש להן meta (תאריך+משמרת)
-        for col, (date_iso, shift) in col_meta.items():
-            cell = ws.cell(r, col)
-            scanned_cells += 1
-
-            dbg = cell_fill_debug(cell)
-
-            if is_payroll_done_cell(cell):
-                key = f"{date_iso}|{name}|{shift}"
-
-                payroll[key] = {
-                    "done": True,
-                    "updated_at": now,
-                    "by": by
-                }
-                updated += 1
-
-
-                # דיבאג: נדפיס כמה דוגמאות ראשונות כדי לוודא שאנחנו תופסים צבעים
-                if sample_printed < 8:
-                    dbg = cell_fill_debug(cell)
-                    print(f"[PAYROLL DEBUG] r={r} c={col} name={name} date={date_iso} shift={shift} fill={dbg}")
-                    sample_printed += 1
-
-    save_payroll_status(payroll)
-    save_touch_log(touch_log)
+    try:
+        with span("payroll_scan"):
+            for r, name, cells in iter_payroll_sheet(ws, col_meta):
+                # עובר רק על עמודות דינמיות שיש להן meta (תאריך+משמרת)
+                for col, (date_iso, shift) in col_meta.items():
+                    cell = _row_cell(cells, col)
+                    scanned_cells += 1
+
+                    if is_done(cell):
+                        key = f"{date_iso}|{name}|{shift}"
+
+                        changes[key] = {
+                            "done": True,
+                            "updated_at": now,
+                            "by": by
+                        }
+                        updated += 1
+
+
+                        # דיבאג: נדפיס כמה דוגמאות ראשונות כדי לוודא שאנחנו תופסים צבעים
+                        if PAYROLL_DEBUG and sample_printed < 8:
+                            dbg = cell_fill_debug(cell)
+                            print(f"[PAYROLL DEBUG] r={r} c={col} name={name} date={date_iso} shift={shift} fill={dbg}")
+                            sample_printed += 1
+    except Exception as ex:
+        return jsonify({"error": f"failed to read xlsx: {ex}"}), 400
+    finally:
+        wb.close()
+
+    with _payroll_upload_lock, file_lock("payroll_upload"):
+        # גרסת שינוי: רק מפתחות חדשים או שה-done שלהם השתנה מקבלים את הגרסה
+        # החדשה (עבור /payroll-status?since=)
+        payroll_meta = load_payroll_meta()
+        version = int(payroll_meta.get("version", 0)) + 1
+        existing = get_payroll_entries(changes)
+        for key, rec in changes.items():
+            old = existing.get(key)
+            if old is not None and bool(old.get("done")) == rec["done"]:
+                rec["version"] = old.get("version", 0)
+            else:
+                rec["version"] = version
+
+        update_payroll_status(changes)
+        total_keys = count_payroll_status()
+
+        log_action("upload payroll", [f"updated={updated}"])
+        update_state("upload payroll")
 
-    log_action("upload payroll", [f"updated={updated}"])
-    update_state("upload payroll")
-    
         # ✅ אישור שכר גלובלי – זה מקור האמת
-    save_payroll_meta({
-        "last_upload_at": now,
-        "by": by
-    })
+        payroll_meta.update({
+            "last_upload_at": now,
+            "by": by,
+            "version": version,
+        })
+        save_payroll_meta(payroll_meta)
+    profile_note(meta_cols=len(col_meta), scanned_cells=scanned_cells, updated=updated)
+
     # דיבאג מסכם
-    print("PAYROLL DEBUG SUMMARY:",
-          "col_meta_cols=", len(col_meta),
-          "scanned_cells=", scanned_cells,
-          "marked_cells=", marked_cells,
-          "updated_new=", updated,
-          "TOTAL_PAYROLL_KEYS=", len(payroll))
+    if PAYROLL_DEBUG:
+        print("PAYROLL DEBUG SUMMARY:",
+              "col_meta_cols=", len(col_meta),
+              "scanned_cells=", scanned_cells,
+              "marked_cells=", marked_cells,
+              "updated_new=", updated,
+              "TOTAL_PAYROLL_KEYS=", total_keys)
 
     return jsonify({
         "ok": True,
         "updated": updated,
-        "total_keys": len(payroll),
+        "total_keys": total_keys,
         "scanned_cells": scanned_cells,
         "marked_cells": marked_cells,
         "meta_cols": len(col_meta),
@@ -999,40 +2843,191 @@ def upload_payroll():
 @app.route("/payroll-status", methods=["GET"])
 @login_required
 def payroll_status():
-    data = load_payroll_status()
-    return jsonify(data)
+    """
+    בלי פרמטרים — כל המפה (כמו תמיד).
+    ?since=<version>&from=&to= — רק מפתחות שנוספו/השתנו אחרי version,
+    בטווח התאריכים: {"version", "full", "changes"}. full=true אומר ללקוח
+    להחליף את המפה (since חדש מדי, או שהיה איפוס מאז).
+    """
+    args = request.args
+    if not any(k in args for k in ("since", "from", "to")):
+        data = load_payroll_status()
+        return jsonify(data)
 
+    try:
+        since = int(args["since"]) if args.get("since") else None
+        date_from = _parse_date(args["from"]).isoformat() if args.get("from") else None
+        date_to = _parse_date(args["to"]).isoformat() if args.get("to") else None
+    except ValueError:
+        return jsonify({"error": "bad since/from/to"}), 400
 
-@app.get("/payroll-dirty")
-@login_required
-def payroll_dirty():
-    touch_log = load_touch_log()
+    return jsonify(payroll_status_delta(since, date_from, date_to))
+
+
+def payroll_status_delta(since=None, date_from=None, date_to=None):
     payroll_meta = load_payroll_meta()
+    version = int(payroll_meta.get("version", 0))
+    full = (
+        since is None
+        or since > version
+        or since < int(payroll_meta.get("reset_version", 0))
+    )
 
+    return {
+        "version": version,
+        "full": full,
+        "changes": payroll_status_since(None if full else since, date_from, date_to),
+    }
+
+
+def _payroll_dirty_cutoff(payroll_meta):
+    # touched_at שאחריו רשומה נחשבת "מלוכלכת" (None — עוד לא הועלה אקסל שכר)
     last_payroll_at = payroll_meta.get("last_upload_at")
     if not last_payroll_at:
-        return jsonify({})
-
+        return None
     try:
-        t_payroll = dt.datetime.fromisoformat(last_payroll_at)
+        return dt.datetime.fromisoformat(last_payroll_at).strftime("%Y-%m-%d %H:%M:%S")
     except Exception:
-        return jsonify({})
+        return None
 
-    dirty = {}
+def compute_payroll_dirty(since=None):
+    """
+    רשומות ששונו אחרי העלאת השכר האחרונה → (dirty, cursor, full).
+    since הוא cursor קודם; אם בינתיים הועלה אקסל שכר חדש — חוזרת הרשימה
+    המלאה (full=True) כי רשומות ישנות כבר לא "מלוכלכות".
+    """
+    payroll_meta = load_payroll_meta()
 
-    for key, t in touch_log.items():
-        try:
-            t_touch = dt.datetime.fromisoformat(t.get("touched_at"))
-        except Exception:
-            continue
+    last_payroll_at = payroll_meta.get("last_upload_at")
+    cutoff = _payroll_dirty_cutoff(payroll_meta)
+    if not cutoff:
+        return {}, None, True
+
+    since_upload, _, since_touch = (since or "").partition("~")
+    full = since_upload != last_payroll_at or not since_touch
+
+    if full:
+        rows = touch_log_since(cutoff)
+    else:
+        rows = touch_log_since(since_touch, inclusive=True)
+
+    dirty = {}
+    cursor = cutoff if full else since_touch
 
+    for key, t in rows:
         # 🔴 שינוי אחרי אישור שכר
-        if t_touch > t_payroll:
+        if t["touched_at"] > cutoff:
             dirty[key] = {
                 "touched_at": t["touched_at"],
                 "by": t["by"]
             }
+            cursor = max(cursor, t["touched_at"])
+
+    return dirty, f"{last_payroll_at}~{cursor}", full
+
+
+@app.get("/payroll-dirty")
+@login_required
+def payroll_dirty():
+    """
+    ?since=<cursor> (מהכותרת X-Dirty-Cursor של התשובה הקודמת) מחזיר רק מה
+    שנגעו בו מאז; X-Dirty-Full: 1 אומר ללקוח להחליף את כל המפה.
+    """
+    dirty, cursor, full = compute_payroll_dirty(request.args.get("since"))
+
+    resp = jsonify(dirty)
+    if cursor:
+        resp.headers["X-Dirty-Cursor"] = cursor
+        resp.headers["X-Dirty-Full"] = "1" if full else "0"
+    return resp
+
+
+@app.get("/payroll-state")
+@login_required
+def payroll_state():
+    """
+    status + dirty בקריאה אחת, עם ETag לפי storage_version().
+    כל עוד לא נכתב כלום — If-None-Match מחזיר 304 בלי לטעון את הנתונים.
+    ?since=<version> — status מגיע כ-delta (status_full=false) במקום המפה המלאה.
+    """
+    etag = hashlib.sha1(repr(storage_version()).encode()).hexdigest()[:16]
+
+    if etag in request.if_none_match:
+        resp = app.response_class(status=304)
+    else:
+        try:
+            since = int(request.args["since"]) if request.args.get("since") else None
+        except ValueError:
+            return jsonify({"error": "bad since"}), 400
+
+        delta = payroll_status_delta(since)
+        dirty, _, _ = compute_payroll_dirty()
+        resp = jsonify({
+            "status": delta["changes"],
+            "status_full": delta["full"],
+            "version": delta["version"],
+            "dirty": dirty,
+        })
+
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+def payroll_dirty_names(date):
+    # עובדים שנגעו בהם בתאריך אחרי העלאת השכר האחרונה
+    cutoff = _payroll_dirty_cutoff(load_payroll_meta())
+    if not cutoff:
+        return set()
+    if STORAGE_BACKEND == "sqlite":
+        rows = get_db().execute(
+            "SELECT DISTINCT name FROM touch_log WHERE date = ? AND touched_at > ?",
+            (date, cutoff)
+        )
+        return {name for (name,) in rows}
+    # רק הנגיעות שאחרי ה-cutoff (אינדקס touched_at), לא כל ההיסטוריה
+    names = set()
+    for key, _ in touch_log_since(cutoff):
+        d, name, _ = split_key(key)
+        if d == date:
+            names.add(name)
+    return names
+
+def compute_payroll_rollup(date):
+    """
+    name → "dirty" / "done" / "none" לכל עובד ב-roster בתאריך אחד
+    (dirty גובר על done — כמו הנקודה במסך).
+    """
+    rollup = dict.fromkeys(get_roster()["emp_row"], "none")
+    for name in payroll_done_names(date):
+        rollup[name] = "done"
+    for name in payroll_dirty_names(date):
+        rollup[name] = "dirty"
+    return rollup
+
+
+@app.get("/payroll-rollup")
+@login_required
+def payroll_rollup():
+    """
+    ?date=YYYY-MM-DD — סטטוס שכר לכל עובד בתאריך, במקום המפות המלאות של
+    status/dirty (הגודל לפי ה-roster ולא לפי ההיסטוריה). ETag כמו ב-/payroll-state.
+    """
+    try:
+        date = _parse_date(request.args.get("date", "")).isoformat()
+    except Exception:
+        return jsonify({"error": "date invalid. expected YYYY-MM-DD"}), 400
+
+    version = (storage_version(), _file_key(TEMPLATE), date)
+    etag = hashlib.sha1(repr(version).encode()).hexdigest()[:16]
+
+    if etag in request.if_none_match:
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify({"date": date, "employees": compute_payroll_rollup(date)})
 
-    return jsonify(dirty)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,411 @@
+"""
+בנצ'מרק על נתונים סינתטיים — מודד את הנתיבים החמים דרך ה-test client של Flask:
+load_teams_with_rows, /touch, /payroll-dirty, /payroll-rollup, /export (שני המנועים), /upload-payroll.
+
+    python bench.py [--sizes small,medium,large] [--repeat 3] [--storage json|journal|sqlite]
+                    [--out results.json] [--compare old_results.json]
+                    [--teams N] [--per-team N] [--managers N] [--days N] [--entries N] [--merges N]
+
+גודל מותאם: --sizes "huge:teams=40,per_team=80,merges=200" — הערכים שלא צוינו באים
+מה-preset באותו שם (large:days=60), ולשם חדש מ-small. --teams וכו' דורסים בכל הגדלים.
+merges = מיזוגים נוספים שהנהלת חשבונות מוסיפה בשורות העובדים בקובץ השכר
+(יום שלם של עובד אחד), בנפרד ממיזוגי שורות הצוותים.
+
+הכל רץ בתיקייה זמנית (מבנה.xlsx, data/, audit.log, config) — הקבצים האמיתיים לא נוגעים.
+התוצאות ב-JSON (best/median לכל פעולה וגודל) כדי להשוות בין ריצות.
+"""
+import argparse
+import datetime as dt
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import openpyxl
+from openpyxl.styles import PatternFill, Font, Border, Side
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SIZES = {
+    "small":  {"teams": 3,  "per_team": 15, "managers": 5,  "days": 7,  "entries": 100,  "merges": 0},
+    "medium": {"teams": 8,  "per_team": 40, "managers": 10, "days": 14, "entries": 1000, "merges": 0},
+    "large":  {"teams": 15, "per_team": 60, "managers": 15, "days": 31, "entries": 5000, "merges": 0},
+}
+SIZE_PARAMS = tuple(SIZES["small"])
+
+BENCH_USER = "bench"
+BENCH_PASSWORD = "bench-password"
+TOUCH_BATCH = 50          # כמו "שמור הכל" של מנהל משמרת
+PAYROLL_DONE_RATIO = 0.6  # חלק התאים המלאים שנצבעים כמאושרי שכר
+START_DATE = dt.date(2025, 1, 1)
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+# ================= SYNTHETIC DATA =================
+def make_template(path, teams, per_team, managers, days, shifts):
+    """
+    מבנה.xlsx סינתטי באותו layout: כותרות בשורות 4-5, מנהלי משמרת בלי צוות,
+    ואז לכל צוות שורה ממוזגת לרוחב + העובדים שלו.
+    """
+    wb = openpyxl.Workbook()
+    ws = wb.active
+
+    ws["A1"] = "דוח שעות"
+    ws["A1"].font = Font(bold=True, size=16)
+    ws.merge_cells("A1:B1")
+    ws["A4"] = "שם"
+    ws["B4"] = "ת.ז"
+    ws.merge_cells("A4:A5")
+    ws.merge_cells("B4:B5")
+
+    col = 3
+    for d in range(days):
+        ws.cell(4, col, f"יום {d + 1}")
+        ws.merge_cells(start_row=4, start_column=col, end_row=4, end_column=col + len(shifts) - 1)
+        for i, shift in enumerate(shifts):
+            ws.cell(5, col + i, f"משמרת {shift}")
+        col += len(shifts)
+    last_col = col - 1
+
+    names = []
+    row = 6
+    for i in range(managers):
+        name = f"מנהל {i}"
+        ws.cell(row, 1, name)
+        ws.cell(row, 2, 1000 + i)
+        names.append(name)
+        row += 1
+
+    team_fill = PatternFill("solid", fgColor="FFE699")
+    for t in range(teams):
+        ws.cell(row, 1, f"צוות {t}")
+        ws.cell(row, 1).fill = team_fill
+        ws.cell(row, 1).font = Font(bold=True)
+        ws.merge_cells(start_row=row, start_column=1, end_row=row, end_column=last_col)
+        row += 1
+        for i in range(per_team):
+            name = f"עובד {t}-{i}"
+            ws.cell(row, 1, name)
+            ws.cell(row, 2, 100000 + t * 1000 + i)
+            names.append(name)
+            row += 1
+
+    thin = Side(style="thin")
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    for cells in ws.iter_rows(min_row=4, max_row=row - 1, min_col=1, max_col=last_col):
+        for cell in cells:
+            cell.border = border
+
+    ws.sheet_view.rightToLeft = True
+    ws.freeze_panes = "C6"
+    ws.column_dimensions["A"].width = 22
+    ws.column_dimensions["B"].width = 12
+    wb.save(path)
+    return names
+
+
+def make_entries(rng, names, days, count, shifts, actions):
+    # רשומות ייחודיות לפי date|name|shift, כמו שה-UI שולח
+    seen = {}
+    while len(seen) < min(count, len(names) * days * len(shifts)):
+        date = (START_DATE + dt.timedelta(days=rng.randrange(days))).isoformat()
+        name = rng.choice(names)
+        shift = rng.choice(shifts)
+        seen[(date, name, shift)] = {
+            "date": date,
+            "name": name,
+            "shift": shift,
+            "action": rng.choice(actions),
+            "note": rng.choice(["", "", "החלפה", "אישור מנהל"]),
+        }
+    return list(seen.values())
+
+
+def make_payroll_workbook(rng, export_bytes, orange_rgbs, days, shifts, merges):
+    """
+    אקסל שכר כמו שחוזר מהנהלת חשבונות: הייצוא שלנו, עם חלק מהתאים המלאים
+    צבועים כתום (מאושר), וגם כמה תאים ריקים צבועים (רעש שצריך להתעלם ממנו).
+    merges: כמה ימים (כל המשמרות של עובד אחד ביום) ממוזגים לתא אחד.
+    """
+    wb = openpyxl.load_workbook(io.BytesIO(export_bytes))
+    ws = wb.active
+    fills = [PatternFill("solid", fgColor=rgb) for rgb in sorted(orange_rgbs)]
+
+    for cells in ws.iter_rows(min_row=6, min_col=3):
+        for cell in cells:
+            if cell.value and rng.random() < PAYROLL_DONE_RATIO:
+                cell.fill = rng.choice(fills)
+            elif not cell.value and rng.random() < 0.01:
+                cell.fill = rng.choice(fills)
+
+    team_rows = {r.min_row for r in ws.merged_cells.ranges if r.min_row == r.max_row}
+    emp_rows = [r for r in range(6, ws.max_row + 1) if r not in team_rows]
+    slots = [(r, d) for r in emp_rows for d in range(days)]
+    for r, d in rng.sample(slots, min(merges, len(slots))):
+        col = 3 + d * len(shifts)
+        ws.merge_cells(start_row=r, start_column=col, end_row=r, end_column=col + len(shifts) - 1)
+
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+# ================= HARNESS =================
+def import_app(workdir, storage):
+    """
+    טוען את app.py ומפנה את כל נתיבי הקבצים שלו (שמתחת ל-APP_DIR) לתיקייה הזמנית.
+    """
+    os.environ["SHIFTCHANGE_STORAGE"] = storage
+    os.environ.setdefault("SHIFTCHANGE_BOOT_ID", "bench")   # לא לכתוב boot.json אמיתי
+    sys.path.insert(0, APP_DIR)
+    import app as A
+
+    prefix = A.APP_DIR + os.sep
+    for name, value in list(vars(A).items()):
+        if name.isupper() and isinstance(value, str) and value.startswith(prefix):
+            setattr(A, name, os.path.join(workdir, value[len(prefix):]))
+
+    with open(os.path.join(APP_DIR, "config.json"), encoding="utf-8") as f:
+        cfg = json.load(f)
+    cfg["users"] = {BENCH_USER: {"password": BENCH_PASSWORD, "role": "admin"}}
+    with open(A.CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump(cfg, f, ensure_ascii=False, indent=2)
+    return A
+
+
+def login(A):
+    client = A.app.test_client()
+    r = client.post("/login", data={"username": BENCH_USER, "password": BENCH_PASSWORD})
+    if r.status_code != 302:
+        raise RuntimeError(f"login failed: {r.status_code}")
+    return client
+
+
+def check(r, expected=200):
+    if r.status_code != expected:
+        raise RuntimeError(f"{r.request.path}: {r.status_code} {r.data[:200]!r}")
+    return r
+
+
+def timed(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return {
+        "best_s": round(min(times), 6),
+        "median_s": round(statistics.median(times), 6),
+        "runs": len(times),
+    }
+
+
+def bench_size(A, client, size, params, repeat, rng):
+    results = []
+
+    def record(op, timing, **extra):
+        results.append({"size": size, "op": op, **extra, **timing})
+        log(f"  {size:<7} {op:<28} best={timing['best_s'] * 1000:9.1f}ms  median={timing['median_s'] * 1000:9.1f}ms")
+
+    def reset():
+        A.reset_storage()
+        A.reset_audit_log()
+
+    names = make_template(
+        A.TEMPLATE, params["teams"], params["per_team"], params["managers"],
+        params["days"], A.SHIFT_TYPES
+    )
+    entries = make_entries(rng, names, params["days"], params["entries"], A.SHIFT_TYPES, A.ACTIONS)
+    report = {
+        "report_from": START_DATE.isoformat(),
+        "report_to": (START_DATE + dt.timedelta(days=params["days"] - 1)).isoformat(),
+    }
+    employees = len(names)
+
+    # --- roster parse ---
+    record("load_teams_with_rows:cold",
+           timed(A.load_teams_with_rows, repeat, setup=A._template_cache.clear),
+           employees=employees)
+    record("load_teams_with_rows:warm", timed(A.load_teams_with_rows, repeat), employees=employees)
+
+    # --- touch (ב-batches, על אחסון ריק) ---
+    def touch_all():
+        for i in range(0, len(entries), TOUCH_BATCH):
+            check(client.post("/touch", json={"entries": entries[i:i + TOUCH_BATCH]}))
+
+    record("touch", timed(touch_all, repeat, setup=reset), entries=len(entries), batch=TOUCH_BATCH)
+
+    # --- payroll-dirty: כל הנגיעות אחרי העלאת השכר האחרונה ---
+    upload_at = (dt.datetime.now() - dt.timedelta(hours=1)).isoformat(timespec="seconds")
+    meta = A.load_payroll_meta()
+    meta.update(last_upload_at=upload_at, by=BENCH_USER)
+    A.save_payroll_meta(meta)
+    dirty = check(client.get("/payroll-dirty")).json
+    record("payroll-dirty", timed(lambda: check(client.get("/payroll-dirty")), repeat),
+           dirty=len(dirty))
+    record("payroll-state", timed(lambda: check(client.get("/payroll-state")), repeat))
+    rollup_url = f"/payroll-rollup?date={report['report_from']}"
+    record("payroll-rollup", timed(lambda: check(client.get(rollup_url)), repeat), employees=employees)
+
+    # --- export ---
+    export_bytes = None
+    for engine in A.EXPORT_ENGINES:
+        body = dict(report, entries=entries, engine=engine)
+
+        def export():
+            nonlocal export_bytes
+            export_bytes = check(client.post("/export", json=body)).data
+
+        record(f"export:{engine}", timed(export, repeat), entries=len(entries), days=params["days"])
+
+    # אותו ייצוא כשהרשומות נקראות מהשרת (הבקשה נושאת רק את הטווח)
+    body = dict(report, source="server")
+    record("export:server", timed(lambda: check(client.post("/export", json=body)), repeat),
+           entries=len(entries), days=params["days"])
+
+    # --- upload payroll ---
+    payroll_bytes = make_payroll_workbook(
+        rng, export_bytes, A.PAYROLL_ORANGE_RGB, params["days"], A.SHIFT_TYPES, params["merges"]
+    )
+    uploaded = {}
+
+    def upload():
+        uploaded.update(check(client.post(
+            "/upload-payroll",
+            data={"file": (io.BytesIO(payroll_bytes), "payroll.xlsx")},
+            content_type="multipart/form-data",
+        )).json)
+
+    timing = timed(upload, repeat, setup=reset)
+    record("upload-payroll", timing, bytes=len(payroll_bytes), employees=employees,
+           days=params["days"], marked=uploaded.get("updated"))
+
+    return results
+
+
+def parse_sizes(spec, overrides):
+    """
+    "small,huge:teams=40,per_team=80" → {name: params}. key=value אחרי פסיק
+    שייך לגודל שלפניו; overrides (מה-CLI, None = לא צוין) חלים על כולם.
+    """
+    tokens = []
+    for token in (t.strip() for t in spec.split(",")):
+        if not token:
+            continue
+        if "=" in token and ":" not in token and tokens:
+            tokens[-1] += "," + token
+        else:
+            tokens.append(token)
+
+    sizes = {}
+    for token in tokens:
+        name, _, rest = token.partition(":")
+        name = name.strip()
+        params = dict(SIZES.get(name, SIZES["small"]))
+        if not rest and name not in SIZES:
+            raise ValueError(f"unknown size: {name} (presets: {', '.join(SIZES)})")
+        for item in filter(None, (i.strip() for i in rest.split(","))):
+            key, _, value = item.partition("=")
+            key = key.strip()
+            if key not in SIZE_PARAMS:
+                raise ValueError(f"{name}: unknown parameter {key} (from: {', '.join(SIZE_PARAMS)})")
+            params[key] = int(value)
+        params.update({k: v for k, v in overrides.items() if v is not None})
+        if params["days"] < 1 or min(params.values()) < 0:
+            raise ValueError(f"{name}: invalid parameters {params}")
+        sizes[name] = params
+    return sizes
+
+
+def compare(results, old_path, sizes):
+    with open(old_path, encoding="utf-8") as f:
+        old_run = json.load(f)
+    old = {(r["size"], r["op"]): r for r in old_run["results"]}
+    log(f"\ncompared to {old_path} (best, new/old):")
+
+    # משווים רק גדלים שרצו עם אותם פרמטרים (בקבצים ישנים אין merges — היה 0)
+    skipped = set()
+    for name, params in sizes.items():
+        prev_params = old_run.get("meta", {}).get("sizes", {}).get(name)
+        if prev_params is not None and dict({"merges": 0}, **prev_params) != params:
+            log(f"  {name:<7} skipped: parameters differ ({prev_params} vs {params})")
+            skipped.add(name)
+
+    for r in results:
+        if r["size"] in skipped:
+            continue
+        prev = old.get((r["size"], r["op"]))
+        if prev and prev["best_s"]:
+            ratio = r["best_s"] / prev["best_s"]
+            flag = "  <-- slower" if ratio > 1.2 else ""
+            log(f"  {r['size']:<7} {r['op']:<28} x{ratio:5.2f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="small,medium",
+                        help=f"presets: {','.join(SIZES)}, או name:teams=..,per_team=..")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--storage", default="json", choices=["json", "journal", "sqlite"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="קובץ JSON לתוצאות (ברירת מחדל: stdout)")
+    parser.add_argument("--compare", help="קובץ תוצאות קודם להשוואה")
+    for key in SIZE_PARAMS:
+        parser.add_argument(f"--{key.replace('_', '-')}", dest=key, type=int,
+                            help=f"דורס את {key} בכל הגדלים")
+    args = parser.parse_args()
+
+    try:
+        sizes = parse_sizes(args.sizes, {k: getattr(args, k) for k in SIZE_PARAMS})
+    except ValueError as e:
+        parser.error(str(e))
+
+    workdir = tempfile.mkdtemp(prefix="shiftchange-bench-")
+    try:
+        A = import_app(workdir, args.storage)
+        client = login(A)
+        rng = random.Random(args.seed)
+
+        results = []
+        for size, params in sizes.items():
+            log(f"[{size}] {params}")
+            results += bench_size(A, client, size, params, args.repeat, rng)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    out = {
+        "meta": {
+            "started_at": dt.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "openpyxl": openpyxl.__version__,
+            "platform": platform.platform(),
+            "storage": args.storage,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "sizes": sizes,
+        },
+        "results": results,
+    }
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(out, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(out, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+    if args.compare:
+        compare(results, args.compare, sizes)
+
+
+if __name__ == "__main__":
+    main()
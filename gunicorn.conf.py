@@ -0,0 +1,17 @@
+# הרצה מרובת תהליכים:
+#     gunicorn -c gunicorn.conf.py app:app
+# (pip install gunicorn — לא נדרש להרצה הרגילה עם app.run)
+import os
+import time
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = 120   # ייצוא/העלאת אקסל גדולים
+
+
+def on_starting(server):
+    # נקבע פעם אחת בתהליך הראשי לפני ה-fork — כל ה-workers חולקים את
+    # אותו boot id (הפעלה מחדש של השרת עדיין מנתקת את כולם)
+    os.environ["SHIFTCHANGE_MULTIPROCESS"] = "1"
+    os.environ["SHIFTCHANGE_BOOT_ID"] = str(int(time.time()))
@@ -0,0 +1,311 @@
+"""
+בדיקת עומס מקומית: מרים את האפליקציה בשרת threaded על 127.0.0.1, מחבר N משתמשים
+מדומים (כל אחד עם session משלו) ומריץ תערובת של /touch, /payroll-status,
+/payroll-dirty, /payroll-rollup, / ו-/export לאורך זמן קבוע.
+
+    python loadtest.py [--users 30] [--duration 20] [--storage json|journal|sqlite]
+                       [--think 0.05] [--size small] [--out results.json]
+
+מדווח throughput ו-p50/p95/p99 לכל route, ובסוף בודק lost updates: כל משתמש כותב
+רק למפתחות (date|name|shift) שלו, אז הערך האחרון שקיבל עליו 200 חייב להופיע
+ב-touch_log ובמאגר הרשומות. הכל רץ בתיקייה זמנית (ראה bench.py) — בלי שירותים חיצוניים.
+"""
+import argparse
+import datetime as dt
+import http.cookiejar
+import json
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from bench import SIZES, START_DATE, import_app, make_template, log
+
+# משקל יחסי של כל route בתערובת
+DEFAULT_MIX = {
+    "touch": 40,
+    "payroll-status": 15,
+    "payroll-dirty": 15,
+    "payroll-rollup": 15,
+    "index": 20,
+    "export": 10,
+}
+USER_PASSWORD = "load-password"
+TOUCH_MAX_BATCH = 10
+EXPORT_DAYS = 7
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    for part in filter(None, (p.strip() for p in (text or "").split(","))):
+        route, _, weight = part.partition("=")
+        if route not in DEFAULT_MIX:
+            raise ValueError(f"unknown route in mix: {route}")
+        mix[route] = int(weight)
+    return {k: v for k, v in mix.items() if v > 0}
+
+
+def percentile(sorted_values, p):
+    # nearest-rank
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+class QuietHandler(WSGIRequestHandler):
+    # בלי שורת לוג לכל בקשה — אלפי בקשות בשנייה
+    def log_request(self, *args, **kwargs):
+        pass
+
+# ================= SIMULATED USER =================
+class SimUser:
+    def __init__(self, base_url, username, own_names, days, shifts, actions, rng):
+        self.base_url = base_url
+        self.username = username
+        self.own_names = own_names
+        self.days = days
+        self.shifts = shifts
+        self.actions = actions
+        self.rng = rng
+        self.expected = {}    # key -> הערך האחרון שאושר (200) עבורו
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, method, path, body=None, form=None):
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode("utf-8")
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(req, timeout=120) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as ex:
+            ex.read()
+            return ex.code
+
+    def login(self):
+        status = self.request("POST", "/login", form={"username": self.username, "password": USER_PASSWORD})
+        if status != 200:   # אחרי redirect ל-/
+            raise RuntimeError(f"login failed for {self.username}: {status}")
+
+    def _random_entry(self):
+        date = (START_DATE + dt.timedelta(days=self.rng.randrange(self.days))).isoformat()
+        return {
+            "date": date,
+            "name": self.rng.choice(self.own_names),
+            "shift": self.rng.choice(self.shifts),
+            "action": self.rng.choice(self.actions),
+            "note": f"{self.username}-{self.rng.randrange(1_000_000)}",
+        }
+
+    def do(self, route):
+        if route == "touch":
+            entries = [self._random_entry() for _ in range(self.rng.randint(1, TOUCH_MAX_BATCH))]
+            status = self.request("POST", "/touch", body={"entries": entries})
+            if status == 200:
+                for e in entries:
+                    self.expected[f"{e['date']}|{e['name']}|{e['shift']}"] = f"{e['action']}|{e['note']}"
+            return status
+        if route == "payroll-status":
+            return self.request("GET", "/payroll-status")
+        if route == "payroll-dirty":
+            return self.request("GET", "/payroll-dirty")
+        if route == "payroll-rollup":
+            date = (START_DATE + dt.timedelta(days=self.rng.randrange(self.days))).isoformat()
+            return self.request("GET", f"/payroll-rollup?date={date}")
+        if route == "index":
+            return self.request("GET", "/")
+        if route == "export":
+            # כמו ה-UI: הרשומות נקראות מהשרת (400 = עוד אין רשומות בטווח)
+            status = self.request("POST", "/export", body={
+                "report_from": START_DATE.isoformat(),
+                "report_to": (START_DATE + dt.timedelta(days=EXPORT_DAYS - 1)).isoformat(),
+                "source": "server",
+            })
+            return 200 if status == 400 and not self.expected else status
+        raise ValueError(route)
+
+# ================= RUN =================
+def run(args):
+    mix = parse_mix(args.mix)
+    routes, weights = zip(*mix.items())
+    params = SIZES[args.size]
+    days = min(params["days"], EXPORT_DAYS)
+
+    workdir = tempfile.mkdtemp(prefix="shiftchange-load-")
+    server = None
+    try:
+        A = import_app(workdir, args.storage)
+        names = make_template(
+            A.TEMPLATE, params["teams"], params["per_team"], params["managers"],
+            params["days"], A.SHIFT_TYPES
+        )
+        if len(names) < args.users:
+            raise SystemExit(f"size {args.size} has only {len(names)} employees for {args.users} users")
+
+        with A.edit_config() as cfg:
+            for i in range(args.users):
+                cfg["users"][f"load{i}"] = {"password": USER_PASSWORD, "role": "user"}
+
+        server = make_server("127.0.0.1", 0, A.app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        log(f"server on {base_url} · storage={args.storage} · users={args.users} · {args.duration}s")
+
+        rng = random.Random(args.seed)
+        users = [
+            SimUser(base_url, f"load{i}", names[i::args.users], days, A.SHIFT_TYPES, A.ACTIONS,
+                    random.Random(rng.random()))
+            for i in range(args.users)
+        ]
+        for u in users:
+            u.login()
+
+        samples = []          # (route, seconds, status)
+        samples_lock = threading.Lock()
+        start_barrier = threading.Barrier(len(users) + 1)
+        deadline = [0.0]
+
+        def user_loop(u):
+            local = []
+            start_barrier.wait()
+            while time.perf_counter() < deadline[0]:
+                route = u.rng.choices(routes, weights)[0]
+                t = time.perf_counter()
+                try:
+                    status = u.do(route)
+                except Exception:
+                    status = 0
+                local.append((route, time.perf_counter() - t, status))
+                if args.think:
+                    time.sleep(u.rng.uniform(0, 2 * args.think))
+            with samples_lock:
+                samples.extend(local)
+
+        threads = [threading.Thread(target=user_loop, args=(u,)) for u in users]
+        for t in threads:
+            t.start()
+        deadline[0] = time.perf_counter() + args.duration
+        started = time.perf_counter()
+        start_barrier.wait()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        # --- lost updates ---
+        touch_log = A.load_touch_log()
+        expected = {}
+        for u in users:
+            expected.update(u.expected)
+        missing = [k for k in expected if k not in touch_log]
+        stale = [k for k, v in expected.items() if k in touch_log and touch_log[k].get("value") != v]
+
+        # אותה בדיקה על מאגר הרשומות (מקור הייצוא)
+        stored = A.get_entries(expected)
+        missing += [f"entries:{k}" for k in expected if k not in stored]
+        stale += [f"entries:{k}" for k, v in expected.items()
+                  if k in stored and f"{stored[k]['action']}|{stored[k]['note']}" != v]
+    finally:
+        if server:
+            server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    per_route = {}
+    for route in routes:
+        lat = sorted(s for r, s, _ in samples if r == route)
+        errors = sum(1 for r, _, st in samples if r == route and st != 200)
+        per_route[route] = {
+            "requests": len(lat),
+            "errors": errors,
+            "rps": round(len(lat) / elapsed, 2),
+            "mean_ms": round(statistics.mean(lat) * 1000, 2) if lat else None,
+            **{f"p{p}_ms": round(percentile(lat, p) * 1000, 2) if lat else None for p in (50, 95, 99)},
+        }
+
+    return {
+        "meta": {
+            "started_at": dt.datetime.now().isoformat(timespec="seconds"),
+            "storage": args.storage,
+            "users": args.users,
+            "duration_s": round(elapsed, 2),
+            "think_s": args.think,
+            "size": args.size,
+            "mix": mix,
+            "seed": args.seed,
+        },
+        "total": {
+            "requests": len(samples),
+            "errors": sum(1 for _, _, st in samples if st != 200),
+            "rps": round(len(samples) / elapsed, 2),
+        },
+        "routes": per_route,
+        "lost_updates": {
+            "checked_keys": len(expected),
+            "missing": len(missing),
+            "stale": len(stale),
+            "examples": (missing + stale)[:10],
+        },
+    }
+
+
+def print_report(out):
+    log(f"\n{'route':<16}{'req':>7}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}  (ms)")
+    for route, r in out["routes"].items():
+        log(f"{route:<16}{r['requests']:>7}{r['errors']:>6}{r['rps']:>9}"
+            f"{r['p50_ms'] or 0:>9}{r['p95_ms'] or 0:>9}{r['p99_ms'] or 0:>9}")
+    t = out["total"]
+    log(f"{'total':<16}{t['requests']:>7}{t['errors']:>6}{t['rps']:>9}")
+    lost = out["lost_updates"]
+    verdict = "OK" if not (lost["missing"] or lost["stale"]) else "LOST UPDATES"
+    log(f"\nlost updates: {verdict} — checked {lost['checked_keys']} keys, "
+        f"missing={lost['missing']} stale={lost['stale']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=30)
+    parser.add_argument("--duration", type=float, default=20, help="שניות")
+    parser.add_argument("--think", type=float, default=0.05, help="זמן חשיבה ממוצע בין בקשות (שניות)")
+    parser.add_argument("--storage", default="json", choices=["json", "journal", "sqlite"])
+    parser.add_argument("--size", default="small", choices=list(SIZES))
+    parser.add_argument("--mix", help="למשל touch=60,export=0 (ברירת מחדל: " +
+                        ",".join(f"{k}={v}" for k, v in DEFAULT_MIX.items()) + ")")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="קובץ JSON לתוצאות (ברירת מחדל: stdout)")
+    args = parser.parse_args()
+
+    try:
+        out = run(args)
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    print_report(out)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(out, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(out, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+    lost = out["lost_updates"]
+    sys.exit(1 if lost["missing"] or lost["stale"] else 0)
+
+
+if __name__ == "__main__":
+    main()